@@ -0,0 +1,91 @@
+"""
+This script measures how long replay analysis takes
+Run from the main folder: python Development/Benchmark.py <replay files or folders>
+Without replays only lookup microbenchmarks are run.
+
+"""
+
+import os
+import sys
+import time
+import timeit
+
+sys.path.insert(0, os.getcwd())
+from SCOFunctions.ReplayAnalysis import analyse_replay, upgrade_is_in_mastery_upgrades, prestige_talent_name
+from SCOFunctions.SC2Dictionaries import COMasteryUpgrades, prestige_upgrades
+from SCOFunctions.S2Parser import s2_parse_replay
+
+
+def find_files(paths):
+    """ Returns replay files from given files and folders """
+    files = list()
+    for path in paths:
+        if os.path.isdir(path):
+            for root, directories, filenames in os.walk(path):
+                files.extend(os.path.join(root, f) for f in filenames if f.endswith('.SC2Replay'))
+        else:
+            files.append(path)
+    return files
+
+
+def measure(function, *args, repeat=3, **kwargs):
+    """ Returns the best time of `repeat` runs """
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        function(*args, **kwargs)
+        duration = time.perf_counter() - start
+        best = duration if best == None else min(best, duration)
+    return best
+
+
+def benchmark_analysis(files):
+    """ Times parsing and analysis for each replay. Parse cache is not used. """
+    total_parse = 0
+    total_analysis = 0
+    for file in files:
+        parse_time = measure(s2_parse_replay, file, return_events=True, use_cache=False)
+        analysis_time = measure(analyse_replay, file, use_cache=False)
+        total_parse += parse_time
+        total_analysis += analysis_time
+        print(f'{parse_time:7.3f}s parse | {analysis_time:7.3f}s analysis | {os.path.basename(file)}')
+
+    if len(files) > 0:
+        print(f'\nTotal: {total_parse:.3f}s parse | {total_analysis:.3f}s analysis | {len(files)} replays')
+
+
+def scan_mastery_upgrades(upgrade):
+    """ Previous implementation scanning all commanders """
+    for co in COMasteryUpgrades:
+        if upgrade in COMasteryUpgrades[co]:
+            return co, COMasteryUpgrades[co].index(upgrade)
+    return False, 0
+
+
+def scan_prestige_upgrades(upgrade):
+    """ Previous implementation scanning all commanders """
+    for co in prestige_upgrades:
+        if upgrade in prestige_upgrades[co]:
+            return prestige_upgrades[co][upgrade]
+    return None
+
+
+def benchmark_upgrade_lookups(number=20000):
+    """ Compares upgrade lookups with scanning. Upgrades are a mix of mastery, prestige and other upgrades as in a replay. """
+    upgrades = [u for ups in COMasteryUpgrades.values() for u in ups] + [u for ups in prestige_upgrades.values() for u in ups] + [f'Upgrade{i}' for i in range(50)]
+
+    for upgrade in upgrades:
+        assert scan_mastery_upgrades(upgrade) == upgrade_is_in_mastery_upgrades(upgrade)
+        assert scan_prestige_upgrades(upgrade) == prestige_talent_name(upgrade)
+
+    for name, old, new in (('Mastery', scan_mastery_upgrades, upgrade_is_in_mastery_upgrades), ('Prestige', scan_prestige_upgrades, prestige_talent_name)):
+        old_time = timeit.timeit(lambda: [old(u) for u in upgrades], number=number//len(upgrades) + 1)
+        new_time = timeit.timeit(lambda: [new(u) for u in upgrades], number=number//len(upgrades) + 1)
+        print(f'{name} lookups: {old_time:.4f}s scan | {new_time:.4f}s index | {old_time/new_time:.1f}x')
+
+
+if __name__ == '__main__':
+    benchmark_upgrade_lookups()
+    files = find_files(sys.argv[1:])
+    if len(files) > 0:
+        benchmark_analysis(files)
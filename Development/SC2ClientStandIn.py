@@ -0,0 +1,66 @@
+"""
+This script runs a stand-in for the SC2 client API and polls it with SC2ClientPoller
+Run from the main folder: python Development/SC2ClientStandIn.py
+The stand-in goes through menus, loading screen and a game. Polling intervals and request stats are printed.
+
+"""
+
+import os
+import sys
+import json
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.getcwd())
+from SCOFunctions.MSC2Client import SC2ClientPoller
+
+PORT = 6120
+START = time.time()
+players = [{'id': 1, 'name': 'Main', 'type': 'user'}, {'id': 2, 'name': 'Ally', 'type': 'user'}, {'id': 3, 'name': 'Amon', 'type': 'computer'}]
+
+
+def game_state():
+    """ Menus for 10 seconds, loading screen for 5 seconds, then a game """
+    elapsed = time.time() - START
+    if elapsed < 10:
+        return {'isReplay': False, 'displayTime': 812.0, 'players': players}
+    if elapsed < 15:
+        return {'isReplay': False, 'displayTime': 0, 'players': players}
+    return {'isReplay': False, 'displayTime': round(elapsed - 15, 1), 'players': players}
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # Keep-alive like the game client
+
+    def do_GET(self):
+        body = json.dumps(game_state()).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+if __name__ == '__main__':
+    poller = SC2ClientPoller(url=f'http://localhost:{PORT}/game')
+
+    # Game not running yet
+    for i in range(3):
+        poller.poll()
+        print(f'Not running | next poll in {poller.interval}s')
+
+    server = ThreadingHTTPServer(('localhost', PORT), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    START = time.time()
+    while time.time() - START < 35:
+        resp = poller.poll()
+        print(f"{time.time() - START:5.1f}s | displayTime {resp['displayTime']:6} | next poll in {poller.interval}s")
+        poller.wait()
+
+    print(poller.stats())
+    server.shutdown()
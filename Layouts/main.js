@@ -32,6 +32,12 @@ var winrateTime = 12;
 var showingWinrateStats = false;
 var last_shown_file = '';
 var do_not_use_websocket = false;
+var activeSocket = null;
+var replayCache = {}; // Unit tables and icons of recently shown replays
+var replayCacheOrder = [];
+var replayCacheLimit = 32; // Has to be at least the limit of ReplayReferences in the app
+var cachedKeys = ['mainUnits', 'allyUnits', 'amonUnits', 'mainIcons', 'allyIcons'];
+var unitColumns = ['created', 'lost', 'kills', 'fraction'];
 
 //main functionality
 setColors(null, null, null, null);
@@ -141,6 +147,7 @@ function connect_to_socket() {
      };
     function_is_running = true;
     let socket = new WebSocket("ws://localhost:" + PORT);
+    activeSocket = socket;
     socket.onopen = function(e) {};
     socket.onmessage = function(event) {
         if (do_not_use_websocket) {
@@ -171,6 +178,7 @@ function connect_to_socket() {
         }
     };
     socket.onclose = function(event) {
+        activeSocket = null;
         if (event.wasClean) {
             console.log('CLEAN EXIT: ' + event)
         } else {
@@ -184,6 +192,13 @@ function connect_to_socket() {
     };
 }
 
+function sendToApp(data) {
+    //Sends a message to the app through the websocket. The primary overlay doesn't use it.
+    if ((activeSocket != null) && (activeSocket.readyState == WebSocket.OPEN) && !(do_not_use_websocket)) {
+        activeSocket.send(JSON.stringify(data))
+    }
+}
+
 function reconnect_to_socket(message) {
     console.log('Reconnecting..')
     function_is_running = false;
@@ -328,9 +343,62 @@ function mutatorInfo(data) {
     }
 }
 
+function decodeUnits(units) {
+    //Converts unit table columns back into {unit: [created, lost, kills, fraction]}
+    if ((units == null) || (units['names'] == null)) {
+        return units
+    };
+    var decoded = {};
+    for (let idx = 0; idx < units['names'].length; idx++) {
+        decoded[units['names'][idx]] = unitColumns.map(column => units[column][idx])
+    }
+    return decoded
+}
+
+function decodeReplay(data) {
+    //Restores unit tables and icons of replays sent before, and caches new ones
+    //Returns null if the replay isn't cached, the full replay is requested from the app instead
+    var file = data['filepath'];
+    var idx = replayCacheOrder.indexOf(file);
+    if (idx > -1) {
+        replayCacheOrder.splice(idx, 1)
+    };
+
+    if (data['cached']) {
+        var cached = replayCache[file];
+        if (cached == null) {
+            console.log('Replay not cached, requesting it: ' + file);
+            sendToApp({'replayRequest': file});
+            return null
+        };
+        for (let key of cachedKeys) {
+            data[key] = cached[key]
+        }
+    } else {
+        var parts = {};
+        for (let key of cachedKeys) {
+            data[key] = decodeUnits(data[key]);
+            parts[key] = data[key]
+        }
+        replayCache[file] = parts
+    };
+    replayCacheOrder.push(file);
+
+    while (replayCacheOrder.length > replayCacheLimit) {
+        delete replayCache[replayCacheOrder.shift()]
+    }
+    sendToApp({'cachedReplay': file});
+    return data
+}
+
 function postGameStatsTimed(data) {
     //This is a wrapper for postGameStats
     //The goal is to nicely update the data if it's already showing
+    //Returns false if the replay wasn't shown because it isn't cached
+    data = decodeReplay(data);
+    if (data == null) {
+        return false
+    };
     if ((document.getElementById('stats').style.right != '-50vh') && (document.getElementById('stats').style.right != '')) {
 
         // If we are about to show the same data, hide instead
@@ -347,6 +415,7 @@ function postGameStatsTimed(data) {
     } else {
         postGameStats(data);
     }
+    return true
 }
 
 function format_length(seconds) {
@@ -15,6 +15,7 @@ import json
 import shutil
 import platform
 import threading
+import multiprocessing
 import traceback
 import webbrowser
 import urllib.request
@@ -55,6 +56,7 @@ class Signal_Manager(QtCore.QObject):
     
     """
     showHidePerfOverlay = QtCore.pyqtSignal()
+    replaysParsed = QtCore.pyqtSignal(object)
 
 
 class MultipleInstancesRunning(Exception):
@@ -71,6 +73,7 @@ class UI_TabWidget(object):
 
         self.signal_manager = Signal_Manager()
         self.signal_manager.showHidePerfOverlay.connect(self.show_hide_performance_overlay)
+        self.signal_manager.replaysParsed.connect(self.mass_analysis_progress)
 
         ##########################
         ######## MAIN TAB ########
@@ -1269,6 +1272,7 @@ class UI_TabWidget(object):
             'chat_font_scale': 1.3,
             'webflag': 'CoverWindow',
             'full_analysis_atstart': False,
+            'analysis_workers': 0,
             'twitchbot' : {
                            'channel_name': '',
                            'bot_name': '',
@@ -1918,7 +1922,7 @@ class UI_TabWidget(object):
         self.threadpool.start(thread_replays)
 
         # Start mass replay analysis
-        thread_mass_analysis = MUI.Worker(MR.mass_replay_analysis_thread, self.settings['account_folder'])
+        thread_mass_analysis = MUI.Worker(MR.mass_replay_analysis_thread, self.settings['account_folder'], workers=self.settings['analysis_workers'], progress_callback=self.signal_manager.replaysParsed.emit)
         thread_mass_analysis.signals.result.connect(self.mass_analysis_finished)
         self.threadpool.start(thread_mass_analysis)
         logger.info('Starting mass replay analysis')
@@ -2146,6 +2150,17 @@ class UI_TabWidget(object):
                 self.player_winrate_UI_dict[player].hide()
 
 
+    def mass_analysis_progress(self, progress):
+        """ Shows how many replays were parsed so far during mass replay analysis """
+        parsed, total = progress
+        if hasattr(self, 'CAnalysis') or total == 0:
+            return
+        text = f'<b>Please wait. This can take few minutes the first time.<br>Analyzing your replays. {parsed}/{total}</b>'
+        self.LA_Stats_Wait.setText(text)
+        self.LA_Games_Wait.setText(text)
+        self.LA_GamesFound.setText(f"Games parsed: {parsed}/{total}")
+
+
     def mass_analysis_finished(self, result):
         self.CAnalysis = result
 
@@ -2750,6 +2765,7 @@ class UI_TabWidget(object):
 
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support()
     QtWidgets.QApplication.setAttribute(QtCore.Qt.AA_EnableHighDpiScaling)
     app = QtWidgets.QApplication(sys.argv)
 
@@ -0,0 +1,179 @@
+"""
+Sends overlay events to all connected websocket clients.
+
+Events can be published from any thread. They are passed to the event loop of the websocket server,
+serialized once and sent to each client. Clients don't poll, an idle connection only waits until it's closed.
+
+Replay analysis is sent in full only to clients that confirmed they have it cached, others get a reference.
+Clients confirm cached replays with {'cachedReplay': path} and ask for a full replay with {'replayRequest': path}.
+Only a limited number of recent messages is kept. A newly connected client gets the latest
+message of each catch-up kind (e.g. the last replay and player winrates) from them.
+
+"""
+import json
+import asyncio
+import traceback
+from collections import deque
+
+import websockets
+
+from SCOFunctions.MLogging import logclass
+from SCOFunctions.MOverlayProtocol import ReplayReferences, full_payload, reference_payload
+
+logger = logclass('BRDC','INFO')
+event_kinds = ('initEvent', 'replaydata', 'mutatordata', 'playerEvent', 'hideEvent', 'showEvent', 'showHideEvent', 'uploadEvent')
+
+
+def event_kind(event):
+    """ Returns the kind of the overlay event, e.g. 'replaydata' or 'playerEvent' """
+    for kind in event_kinds:
+        if event.get(kind) != None:
+            return kind
+    return None
+
+
+class BroadcastHub:
+    """ Broadcasts events to websocket clients """
+
+    def __init__(self, timeout=1, history=20, catch_up=('replaydata', 'playerEvent')):
+        self.loop = None
+        self.replay_source = None # Function returning replay analysis for a replay path
+        self.clients = dict() # {websocket: ReplayReferences}
+        self.timeout = timeout # Time limit for sending a message to a client (seconds)
+        self.messages_sent = 0
+        self.history = deque(maxlen=history) # Recent messages [(kind, message, file)]
+        self.catch_up = catch_up # Kinds of messages sent to new clients
+
+
+    def start(self, loop, replay_source=None):
+        """ Sets the event loop of the websocket server and the function used to get requested replays """
+        self.loop = loop
+        self.replay_source = replay_source
+
+
+    def publish(self, event):
+        """ Sends the event to all clients. Thread-safe.
+        Events published before the server started are only kept in history for catch-up. """
+        if self.loop == None:
+            logger.info(f'Websocket server not started, {event_kind(event)} kept for new clients')
+            self._record(event)
+            return
+        self.loop.call_soon_threadsafe(self._broadcast, event)
+
+
+    def _record(self, event):
+        """ Serializes the event and adds it to history. Returns (kind, message, file) or `None` if it failed. """
+        kind = event_kind(event)
+        file = event.get('filepath') if kind == 'replaydata' else None
+        try:
+            message = json.dumps(full_payload(event) if kind == 'replaydata' else event)
+        except:
+            logger.error(f'Failed to serialize event\n{traceback.format_exc()}')
+            return None
+
+        self.history.append((kind, message, file))
+        return kind, message, file
+
+
+    def _broadcast(self, event):
+        """ Serializes the event and schedules sending it to each client. Runs in the event loop.
+        Replay analysis is serialized at most twice, in full and as a reference. """
+        self.messages_sent += 1
+        recorded = self._record(event)
+        if recorded == None:
+            return
+        kind, message, file = recorded
+        reference = None
+
+        for websocket, references in tuple(self.clients.items()):
+            if file != None and references.cached(file):
+                if reference == None:
+                    reference = json.dumps(reference_payload(event))
+                asyncio.ensure_future(self._send(websocket, reference, self.messages_sent))
+            else:
+                asyncio.ensure_future(self._send(websocket, message, self.messages_sent, file))
+
+
+    async def _send(self, websocket, message, number, file=None):
+        """ Sends a message to a client. `file` is set for replays sent in full. """
+        try:
+            await asyncio.wait_for(websocket.send(message), timeout=self.timeout)
+            logger.info(f'#{number} message sent through {websocket}')
+        except asyncio.TimeoutError:
+            logger.error(f'#{number} message was timed-out.')
+            # The client might not have cached the replay
+            if file != None and websocket in self.clients:
+                self.clients[websocket].forget(file)
+        except websockets.exceptions.ConnectionClosed:
+            logger.info('Websocket connection closed.')
+            self.clients.pop(websocket, None)
+        except:
+            logger.error(traceback.format_exc())
+
+
+    def recent_messages(self):
+        """ Returns the latest message of each catch-up kind in the order they were sent """
+        latest = dict()
+        for idx, (kind, message, file) in enumerate(self.history):
+            if kind in self.catch_up:
+                latest[kind] = (idx, message, file)
+        return [(message, file) for idx, message, file in sorted(latest.values())]
+
+
+    async def send_replay(self, websocket, file):
+        """ Sends the replay in full to a client that didn't find it in its cache """
+        message = None
+        for kind, sent, sent_file in reversed(self.history):
+            if sent_file == file:
+                message = sent
+                break
+
+        if message == None and self.replay_source != None:
+            try:
+                replay_dict = await self.loop.run_in_executor(None, self.replay_source, file)
+                if replay_dict != None:
+                    message = json.dumps(full_payload(replay_dict))
+            except:
+                logger.error(f'Failed to get requested replay {file}\n{traceback.format_exc()}')
+
+        if message == None:
+            logger.error(f'Requested replay not available {file}')
+            return
+        await self._send(websocket, message, 'request', file)
+
+
+    async def receive(self, websocket, message):
+        """ Handles a message from a client """
+        try:
+            data = json.loads(message)
+        except:
+            logger.error(f'Failed to decode client message: {message}')
+            return
+
+        references = self.clients.get(websocket)
+        if references == None:
+            return
+        if data.get('cachedReplay') != None:
+            references.confirm(data['cachedReplay'])
+        elif data.get('replayRequest') != None:
+            references.forget(data['replayRequest'])
+            await self.send_replay(websocket, data['replayRequest'])
+
+
+    async def serve(self, websocket, init=None):
+        """ Registers the client, sends it the init message and recent messages, and handles its messages until its connection is closed.
+        Sending is scheduled right when the client is registered, so messages published meanwhile aren't lost or sent before them. """
+        self.clients[websocket] = ReplayReferences()
+        if init != None:
+            asyncio.ensure_future(self._send(websocket, json.dumps(init), 'init'))
+        for message, file in self.recent_messages():
+            asyncio.ensure_future(self._send(websocket, message, 'catch-up', file))
+
+        try:
+            async for message in websocket:
+                await self.receive(websocket, message)
+        except websockets.exceptions.ConnectionClosed:
+            pass
+        finally:
+            self.clients.pop(websocket, None)
+            logger.info(f'Websocket connection closed: {websocket}')
@@ -0,0 +1,133 @@
+"""
+Persistent index of replays that were rejected or failed to parse or analyse
+
+Replays are stored by their path together with modification time, so a changed file is tried again.
+Failures to parse or analyse are stored with the analysis version, and are tried again when it changes.
+Rejected replays (non-Blizzard maps, game recovery enabled, no commanders, ...) don't depend on the version.
+It's meant to be used from the main process only. Worker processes return reasons and the main process records them.
+
+"""
+import os
+import time
+import sqlite3
+import threading
+import traceback
+
+from SCOFunctions.MFilePath import truePath
+from SCOFunctions.MLogging import logclass
+
+logger = logclass('NEGC','INFO')
+
+REJECTED = 'rejected'
+PARSE = 'parse'
+ANALYSE = 'analyse'
+
+
+class NegativeCache:
+    """ Replays that were rejected or failed {file: (mtime, kind, reason, version)} """
+
+    def __init__(self, file, recent_limit=60):
+        self.file = file
+        self.recent_limit = recent_limit # Files modified more recently than this (seconds) might be still written into, don't record them
+        self.lock = threading.Lock()
+        self.failures = None
+        self.changed = dict()
+
+
+    @staticmethod
+    def create_table(connection):
+        """ Creates the table. Adds columns missing in older versions. """
+        connection.execute('CREATE TABLE IF NOT EXISTS rejected (file TEXT PRIMARY KEY, mtime REAL, reason TEXT, kind TEXT, version INTEGER)')
+        columns = {row[1] for row in connection.execute('PRAGMA table_info(rejected)')}
+        if not 'kind' in columns:
+            connection.execute(f"ALTER TABLE rejected ADD COLUMN kind TEXT DEFAULT '{REJECTED}'")
+        if not 'version' in columns:
+            connection.execute('ALTER TABLE rejected ADD COLUMN version INTEGER')
+
+
+    def load(self):
+        """ Loads failures from the database """
+        with self.lock:
+            if self.failures != None:
+                return
+            self.failures = dict()
+            try:
+                with sqlite3.connect(self.file) as connection:
+                    self.create_table(connection)
+                    for file, mtime, kind, reason, version in connection.execute('SELECT file, mtime, kind, reason, version FROM rejected'):
+                        self.failures[file] = (mtime, kind, reason, version)
+                connection.close()
+            except:
+                logger.error(f'Failed to load failed replays\n{traceback.format_exc()}')
+
+
+    def __len__(self):
+        self.load()
+        return len(self.failures)
+
+
+    def reason(self, file, kinds=(REJECTED, PARSE, ANALYSE), version=None, mtime=None):
+        """ Returns the reason the replay failed or `None`.
+        Only failures of given `kinds` are considered. Parse and analyse failures have to match the `version`. """
+        self.load()
+        if not file in self.failures:
+            return None
+
+        saved_mtime, kind, reason, saved_version = self.failures[file]
+        if not kind in kinds or (kind != REJECTED and saved_version != version):
+            return None
+
+        try:
+            mtime = os.path.getmtime(file) if mtime == None else mtime
+        except OSError:
+            return None
+
+        return reason if saved_mtime == mtime else None
+
+
+    def is_rejected(self, file, mtime=None):
+        """ Returns True if the replay was rejected as not suitable for stats """
+        return self.reason(file, kinds=(REJECTED,), mtime=mtime) != None
+
+
+    def is_failed(self, file, kinds=(REJECTED, PARSE, ANALYSE), version=None, mtime=None):
+        """ Returns True if the replay was rejected or failed with the same version """
+        return self.reason(file, kinds=kinds, version=version, mtime=mtime) != None
+
+
+    def add(self, file, reason, kind=REJECTED, version=None, mtime=None):
+        """ Records a failed replay. It's written into the database on `save`.
+        Replays modified recently aren't recorded as they might not be finished. """
+        self.load()
+        try:
+            mtime = os.path.getmtime(file) if mtime == None else mtime
+        except OSError:
+            return
+
+        if time.time() - mtime < self.recent_limit:
+            return
+
+        with self.lock:
+            self.failures[file] = (mtime, kind, reason, version)
+            self.changed[file] = (mtime, kind, reason, version)
+
+
+    def save(self):
+        """ Writes new failures into the database """
+        with self.lock:
+            if len(self.changed) == 0:
+                return
+            rows = [(file, mtime, kind, reason, version) for file, (mtime, kind, reason, version) in self.changed.items()]
+            self.changed = dict()
+
+        try:
+            with sqlite3.connect(self.file) as connection:
+                self.create_table(connection)
+                connection.executemany('INSERT OR REPLACE INTO rejected (file, mtime, kind, reason, version) VALUES (?, ?, ?, ?, ?)', rows)
+            connection.close()
+            logger.info(f'Saved {len(rows)} failed replays')
+        except:
+            logger.error(f'Failed to save failed replays\n{traceback.format_exc()}')
+
+
+negative_cache = NegativeCache(truePath('cache_rejected_replays.db'))
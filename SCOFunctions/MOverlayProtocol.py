@@ -0,0 +1,90 @@
+"""
+Compact encoding of replay analysis sent to the overlay.
+
+Unit tables and icons are the bulky part of replay analysis. The overlay keeps them for recently
+shown replays, so when a replay is shown again only the rest of the analysis is sent with `cached` set.
+Unit tables are sent as columns {'names': [...], 'created': [...], 'lost': [...], 'kills': [...], 'fraction': [...]}.
+The parser output isn't used by the overlay and isn't sent.
+
+`ReplayReferences` mirrors which replays a client has cached. A replay is added only after the overlay
+confirms it cached it, until then the client gets it in full. If a reference doesn't find its replay
+(e.g. the page was reloaded), the overlay doesn't show it and asks for the full replay instead.
+
+"""
+import threading
+from collections import OrderedDict
+
+cached_keys = ('mainUnits', 'allyUnits', 'amonUnits', 'mainIcons', 'allyIcons')
+unit_keys = ('mainUnits', 'allyUnits', 'amonUnits')
+skipped_keys = ('parser',)
+unit_columns = ('created', 'lost', 'kills', 'fraction')
+
+
+def columnar_units(units):
+    """ Converts {unit: [created, lost, kills, fraction]} into columns """
+    columns = {'names': list(units)}
+    for idx, column in enumerate(unit_columns):
+        columns[column] = [units[unit][idx] for unit in columns['names']]
+    return columns
+
+
+def reference_payload(event):
+    """ Returns replay analysis without the parts cached by the overlay """
+    payload = {k:v for k,v in event.items() if not k in skipped_keys and not k in cached_keys}
+    payload['cached'] = True
+    return payload
+
+
+def full_payload(event):
+    """ Returns replay analysis with unit tables in columns """
+    payload = {k:v for k,v in event.items() if not k in skipped_keys and not k in unit_keys}
+    for key in unit_keys:
+        if key in event:
+            payload[key] = columnar_units(event[key])
+    return payload
+
+
+class ReplayReferences:
+    """ Replays cached by an overlay client, least recently shown first """
+
+    def __init__(self, limit=16):
+        self.limit = limit
+        self.files = OrderedDict()
+        self.lock = threading.Lock()
+
+
+    def cached(self, file):
+        """ Returns True if the client confirmed it has the replay cached. Marks it as recently shown. """
+        with self.lock:
+            if file in self.files:
+                self.files.move_to_end(file)
+                return True
+            return False
+
+
+    def confirm(self, file):
+        """ Adds the replay after the client confirmed it cached it """
+        with self.lock:
+            self.files[file] = None
+            self.files.move_to_end(file)
+            while len(self.files) > self.limit:
+                self.files.popitem(last=False)
+
+
+    def forget(self, file):
+        """ Removes the replay, e.g. when it might not have been delivered """
+        with self.lock:
+            self.files.pop(file, None)
+
+
+    def clear(self):
+        """ Removes all replays, e.g. when the overlay was reloaded """
+        with self.lock:
+            self.files.clear()
+
+
+    def payload(self, event):
+        """ Returns the replay event encoded for this client """
+        if self.cached(event.get('filepath')):
+            return reference_payload(event)
+        return full_payload(event)
@@ -0,0 +1,237 @@
+"""
+Indexed store for replay analysis results shown on the overlay.
+
+Records are appended to a single file. Each record is a header with key and payload lengths,
+the replay path and the pickled replay analysis. Pickle keeps types (e.g. int dict keys and tuples),
+so a replay is the same whether it comes from memory or from the file. Opening the store only reads headers
+and keys to build an index {path: (offset, size)}, payloads are decoded when they are requested.
+Recently used payloads are kept in memory.
+
+Storing a replay again appends a new record and the index points to it. Old records are
+removed when the file is compacted, which happens on load if they take most of the file.
+
+"""
+import os
+import ast
+import json
+import pickle
+import struct
+import threading
+import traceback
+from collections import OrderedDict
+
+from SCOFunctions.MFilePath import truePath
+from SCOFunctions.MLogging import logclass
+
+logger = logclass('OSTO','INFO')
+header = struct.Struct('<II')
+
+
+class OverlayStore:
+    """ Replay analysis results for the overlay keyed by replay path """
+
+    def __init__(self, file, legacy_file=None, recent_limit=16):
+        self.file = file
+        self.legacy_file = legacy_file # Text file with one replay dict per line used in older versions
+        self.lock = threading.RLock()
+        self.index = None
+        self.dead_bytes = 0
+        self.recent = OrderedDict() # Recently used payloads {path: replay_dict}
+        self.recent_limit = recent_limit
+
+
+    def load(self):
+        """ Builds the index from record headers. Migrates the legacy file if there is no store yet. """
+        with self.lock:
+            if self.index != None:
+                return
+            self.index = dict()
+
+            if not os.path.isfile(self.file) and self.legacy_file != None and os.path.isfile(self.legacy_file):
+                self.migrate(self.legacy_file)
+                return
+
+            if not os.path.isfile(self.file):
+                return
+
+            try:
+                end = self._read_index()
+                # Cut off a record that wasn't finished
+                if end < os.path.getsize(self.file):
+                    logger.error(f'Truncating incomplete record at {end}')
+                    with open(self.file, 'r+b') as f:
+                        f.truncate(end)
+
+                if self.dead_bytes > 1024*1024 and self.dead_bytes > end / 2:
+                    self.compact()
+            except:
+                logger.error(f'Failed to load overlay store\n{traceback.format_exc()}')
+
+
+    def _read_index(self):
+        """ Reads headers and keys of all records. Returns the offset where valid records end. """
+        offset = 0
+        size = os.path.getsize(self.file)
+        with open(self.file, 'rb') as f:
+            while offset + header.size <= size:
+                key_size, data_size = header.unpack(f.read(header.size))
+                end = offset + header.size + key_size + data_size
+                if end > size:
+                    break
+                key = f.read(key_size).decode('utf-8')
+                f.seek(data_size, os.SEEK_CUR)
+
+                if key in self.index:
+                    self.dead_bytes += header.size + len(key.encode('utf-8')) + self.index[key][1]
+                self.index[key] = (offset + header.size + key_size, data_size)
+                offset = end
+        return offset
+
+
+    def __len__(self):
+        self.load()
+        return len(self.index)
+
+
+    def __contains__(self, file):
+        self.load()
+        return file in self.index
+
+
+    def _remember(self, file, replay_dict):
+        """ Adds a payload to recently used ones and drops the least recently used """
+        self.recent[file] = replay_dict
+        self.recent.move_to_end(file)
+        while len(self.recent) > self.recent_limit:
+            self.recent.popitem(last=False)
+
+
+    def get(self, file):
+        """ Returns replay analysis for given replay or `None` """
+        self.load()
+        with self.lock:
+            if file in self.recent:
+                self.recent.move_to_end(file)
+                return self.recent[file]
+
+            if not file in self.index:
+                return None
+            offset, size = self.index[file]
+            try:
+                with open(self.file, 'rb') as f:
+                    f.seek(offset)
+                    replay_dict = self._decode(f.read(size))
+                self._remember(file, replay_dict)
+                return replay_dict
+            except:
+                logger.error(f'Failed to read {file} from overlay store\n{traceback.format_exc()}')
+                return None
+
+
+    def items(self):
+        """ Yields (file, replay analysis) for all stored replays. Reads the file sequentially and doesn't keep payloads in memory. """
+        self.load()
+        with self.lock:
+            records = sorted(self.index.items(), key=lambda x: x[1][0])
+        # Records are only appended, so offsets stay valid without holding the lock
+        try:
+            with open(self.file, 'rb') as f:
+                for file, (offset, size) in records:
+                    f.seek(offset)
+                    yield file, self._decode(f.read(size))
+        except:
+            logger.error(f'Failed to read overlay store\n{traceback.format_exc()}')
+
+
+    def _encode(self, file, replay_dict):
+        key = file.encode('utf-8')
+        data = pickle.dumps(replay_dict, protocol=pickle.HIGHEST_PROTOCOL)
+        return key, data
+
+
+    @staticmethod
+    def _decode(data):
+        """ Decodes a payload. Records from earlier versions are JSON. """
+        if data[:1] == b'{':
+            return json.loads(data.decode('utf-8'))
+        return pickle.loads(data)
+
+
+    def put(self, file, replay_dict):
+        """ Appends replay analysis to the store """
+        self.load()
+        try:
+            key, data = self._encode(file, replay_dict)
+        except:
+            logger.error(f'Failed to encode {file} for overlay store\n{traceback.format_exc()}')
+            return
+
+        with self.lock:
+            try:
+                with open(self.file, 'ab') as f:
+                    offset = f.tell()
+                    f.write(header.pack(len(key), len(data)) + key + data)
+                if file in self.index:
+                    self.dead_bytes += header.size + len(key) + self.index[file][1]
+                self.index[file] = (offset + header.size + len(key), len(data))
+                self._remember(file, replay_dict)
+            except:
+                logger.error(f'Failed to write {file} into overlay store\n{traceback.format_exc()}')
+
+
+    def put_many(self, replays):
+        """ Appends multiple replays at once {file: replay_dict} """
+        self.load()
+        with self.lock:
+            try:
+                with open(self.file, 'ab') as f:
+                    for file, replay_dict in replays.items():
+                        try:
+                            key, data = self._encode(file, replay_dict)
+                        except:
+                            logger.error(f'Failed to encode {file} for overlay store\n{traceback.format_exc()}')
+                            continue
+                        offset = f.tell()
+                        f.write(header.pack(len(key), len(data)) + key + data)
+                        if file in self.index:
+                            self.dead_bytes += header.size + len(key) + self.index[file][1]
+                        self.index[file] = (offset + header.size + len(key), len(data))
+            except:
+                logger.error(f'Failed to write into overlay store\n{traceback.format_exc()}')
+
+
+    def compact(self):
+        """ Rewrites the store with only the latest record for each replay """
+        with self.lock:
+            temp = f'{self.file}.temp'
+            index = dict()
+            with open(self.file, 'rb') as source, open(temp, 'wb') as target:
+                for file, (offset, size) in sorted(self.index.items(), key=lambda x: x[1][0]):
+                    key = file.encode('utf-8')
+                    source.seek(offset)
+                    new_offset = target.tell()
+                    target.write(header.pack(len(key), size) + key + source.read(size))
+                    index[file] = (new_offset + header.size + len(key), size)
+            os.replace(temp, self.file)
+            logger.info(f'Compacted overlay store, removed {self.dead_bytes/1024/1024:.1f} MB')
+            self.index = index
+            self.dead_bytes = 0
+
+
+    def migrate(self, legacy_file):
+        """ Imports replay dicts from the legacy text file. Later lines replace earlier ones. """
+        replays = dict()
+        with open(legacy_file, 'rb') as f:
+            for line in f:
+                try:
+                    replay_dict = ast.literal_eval(line.decode('utf-8'))
+                    if 'replaydata' in replay_dict and 'filepath' in replay_dict:
+                        replays[replay_dict['filepath']] = replay_dict
+                except:
+                    logger.error(f'Failed to parse a line from replay analysis log\n{traceback.format_exc()}')
+
+        self.put_many(replays)
+        logger.info(f'Migrated {len(replays)} replays from {legacy_file}')
+
+
+overlay_store = OverlayStore(truePath('cache_overlay_replays.dat'), legacy_file=truePath('cache_replay_analysis.txt'))
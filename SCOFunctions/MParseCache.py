@@ -0,0 +1,174 @@
+"""
+Cache for decoded replay data shared by all code paths parsing replays.
+
+Decoded header, details, initData, metadata and messages are stored by the replay path
+together with its size and modification time, so a changed file is never served stale data.
+Recently used entries are kept in memory, all entries are kept in a SQLite database.
+Both tiers are bounded by size and evict least recently used entries first.
+
+Worker processes of mass replay analysis don't write into the database. Their new entries are
+returned to the main process with results and written there in batches, so workers don't compete for the database.
+
+"""
+import os
+import time
+import pickle
+import sqlite3
+import threading
+import traceback
+from collections import OrderedDict
+
+from SCOFunctions.MFilePath import truePath
+from SCOFunctions.MLogging import logclass
+
+logger = logclass('PCAC','INFO')
+
+
+def replay_key(file):
+    """ Returns a cache key for the replay (path, size, mtime) """
+    stat = os.stat(file)
+    return (os.path.normpath(file), stat.st_size, stat.st_mtime)
+
+
+class ParseCache:
+    """ Two-tier LRU cache of decoded replay data keyed by (path, size, mtime) """
+
+    def __init__(self, file, memory_limit=32*1024*1024, disk_limit=256*1024*1024):
+        self.file = file
+        self.memory_limit = memory_limit
+        self.disk_limit = disk_limit
+        self.memory = OrderedDict()
+        self.memory_size = 0
+        self.lock = threading.Lock()
+        self.connection = None
+        self.pid = None
+        self.stores = 0
+        self.deferred = None # New entries not written into the database [(key, blob)], used in worker processes
+        self.hits = 0
+        self.misses = 0
+
+
+    def connect(self):
+        """ Opens the database. Reconnects in child processes as connections can't be shared. """
+        if self.connection == None or self.pid != os.getpid():
+            self.connection = sqlite3.connect(self.file, timeout=10, check_same_thread=False)
+            self.pid = os.getpid()
+            self.connection.execute('PRAGMA journal_mode = WAL')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS parsed (file TEXT PRIMARY KEY, size INTEGER, mtime REAL, data BLOB, bytes INTEGER, accessed REAL)')
+            self.connection.commit()
+        return self.connection
+
+
+    def _remember(self, key, data, size):
+        """ Adds data to the memory tier and evicts least recently used entries """
+        if key in self.memory:
+            self.memory_size -= self.memory.pop(key)[1]
+        self.memory[key] = (data, size)
+        self.memory_size += size
+
+        while self.memory_size > self.memory_limit and len(self.memory) > 1:
+            _, (_, evicted_size) = self.memory.popitem(last=False)
+            self.memory_size -= evicted_size
+
+
+    def get(self, key):
+        """ Returns cached data for the key or `None` """
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self.hits += 1
+                return self.memory[key][0]
+
+            try:
+                connection = self.connect()
+                row = connection.execute('SELECT data FROM parsed WHERE file = ? AND size = ? AND mtime = ?', key).fetchone()
+                if row == None:
+                    self.misses += 1
+                    return None
+
+                if self.deferred == None:
+                    with connection:
+                        connection.execute('UPDATE parsed SET accessed = ? WHERE file = ?', (time.time(), key[0]))
+                data = pickle.loads(row[0])
+                self._remember(key, data, len(row[0]))
+                self.hits += 1
+                return data
+            except:
+                logger.error(f'Failed to read from parse cache\n{traceback.format_exc()}')
+                return None
+
+
+    def put(self, key, data):
+        """ Stores data for the key in both tiers. With deferred writes it's only kept for `take_deferred`. """
+        blob = pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL)
+        with self.lock:
+            self._remember(key, data, len(blob))
+            if self.deferred != None:
+                self.deferred.append((key, blob))
+                return
+        self.store([(key, blob)])
+
+
+    def store(self, entries):
+        """ Writes entries [(key, blob)] into the database in a single transaction """
+        if len(entries) == 0:
+            return
+        with self.lock:
+            try:
+                connection = self.connect()
+                now = time.time()
+                with connection:
+                    connection.executemany('INSERT OR REPLACE INTO parsed (file, size, mtime, data, bytes, accessed) VALUES (?, ?, ?, ?, ?, ?)',
+                                           [(*key, blob, len(blob), now) for key, blob in entries])
+                # Check the size of the database every 100 stored entries
+                if (self.stores + len(entries)) // 100 > self.stores // 100 or self.stores == 0:
+                    self.evict()
+                self.stores += len(entries)
+            except:
+                logger.error(f'Failed to write into parse cache\n{traceback.format_exc()}')
+
+
+    def defer_writes(self):
+        """ Keeps new entries in memory instead of writing them and doesn't update access times. Used in worker processes. """
+        with self.lock:
+            self.deferred = list()
+
+
+    def take_deferred(self):
+        """ Returns new entries kept since the last call """
+        with self.lock:
+            if self.deferred == None:
+                return list()
+            entries = self.deferred
+            self.deferred = list()
+            return entries
+
+
+    def evict(self):
+        """ Removes least recently used entries from the database if it's over its limit """
+        connection = self.connect()
+        total = connection.execute('SELECT COALESCE(SUM(bytes), 0) FROM parsed').fetchone()[0]
+        if total <= self.disk_limit:
+            return
+
+        removed = 0
+        with connection:
+            for file, size in connection.execute('SELECT file, bytes FROM parsed ORDER BY accessed').fetchall():
+                if total <= self.disk_limit * 0.9:
+                    break
+                connection.execute('DELETE FROM parsed WHERE file = ?', (file,))
+                total -= size
+                removed += 1
+        logger.info(f'Removed {removed} entries from parse cache')
+
+
+    def clear(self):
+        """ Removes all cached data """
+        with self.lock:
+            self.memory = OrderedDict()
+            self.memory_size = 0
+            with self.connect() as connection:
+                connection.execute('DELETE FROM parsed')
+
+
+parse_cache = ParseCache(truePath('cache_parsed_replays.db'))
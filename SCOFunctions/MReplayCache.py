@@ -0,0 +1,231 @@
+"""
+Incremental cache for replays parsed in mass replay analysis.
+
+Replays are stored in a SQLite database as separate records keyed by the replay path.
+Saving writes only replays that were added or updated, so the cost of a checkpoint
+doesn't grow with the number of replays in the cache.
+
+Each record is split into a summary used for stats (date, map, result, players, ...)
+and details (chat messages, unit stats and icons). Only summaries are loaded at start,
+details are loaded when needed. Summaries keep chat text, so replays can be searched by it.
+
+"""
+import os
+import pickle
+import sqlite3
+import threading
+import traceback
+
+from SCOFunctions.MLogging import logclass
+
+logger = logclass('CACH','INFO')
+detail_keys = ('messages', 'amon_units')
+player_detail_keys = ('units', 'icons')
+summary_version = 2
+
+
+def has_details(replay):
+    """ Returns True if the replay has its details loaded """
+    return 'messages' in replay
+
+
+def split_details(replay):
+    """ Splits the replay into a summary and details. Details are `None` if they aren't loaded. """
+    if not has_details(replay):
+        return replay, None
+
+    summary = {k:v for k,v in replay.items() if not k in detail_keys}
+    summary['chat'] = chat_text(replay['messages'])
+    details = {k:replay[k] for k in detail_keys if k in replay}
+    details['players'] = dict()
+    summary['players'] = list()
+
+    for idx, player in enumerate(replay['players']):
+        summary['players'].append({k:v for k,v in player.items() if not k in player_detail_keys})
+        player_details = {k:player[k] for k in player_detail_keys if k in player}
+        if len(player_details) > 0:
+            details['players'][idx] = player_details
+
+    return summary, details
+
+
+def chat_text(messages):
+    """ Returns text of chat messages joined into a single string """
+    return '\n'.join(m['text'] for m in messages)
+
+
+def merge_details(summary, details):
+    """ Returns a new replay with details added to the summary """
+    if details == None:
+        return summary
+
+    replay = summary.copy()
+    replay['players'] = [p.copy() for p in summary['players']]
+    for key in detail_keys:
+        if key in details:
+            replay[key] = details[key]
+    for idx, player_details in details['players'].items():
+        replay['players'][idx].update(player_details)
+    return replay
+
+
+class ReplayCache:
+    """ Stores parsed replays (S2Parser format) keyed by their file path """
+
+    def __init__(self, file):
+        self.file = file
+        self.lock = threading.Lock()
+        self.connection = None
+
+
+    def connect(self):
+        """ Opens the database and creates tables if necessary """
+        if self.connection == None:
+            self.connection = sqlite3.connect(self.file, check_same_thread=False)
+            self.connection.execute('PRAGMA mmap_size = 268435456')
+            columns = {row[1] for row in self.connection.execute('PRAGMA table_info(replays)')}
+            if 'data' in columns:
+                self.upgrade_table()
+            self.connection.execute('CREATE TABLE IF NOT EXISTS replays (file TEXT PRIMARY KEY, summary BLOB, details BLOB)')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value BLOB)')
+            self.connection.commit()
+            row = self.connection.execute("SELECT value FROM meta WHERE key = 'summary_version'").fetchone()
+            if row == None or pickle.loads(row[0]) < summary_version:
+                self.upgrade_summaries()
+        return self.connection
+
+
+    def upgrade_table(self):
+        """ Splits replays stored as a single record into summaries and details """
+        logger.info('Upgrading replay cache')
+        with self.connection:
+            self.connection.execute('ALTER TABLE replays RENAME TO replays_old')
+            self.connection.execute('CREATE TABLE replays (file TEXT PRIMARY KEY, summary BLOB, details BLOB)')
+            for file, data in self.connection.execute('SELECT file, data FROM replays_old').fetchall():
+                summary, details = split_details(pickle.loads(data))
+                self.connection.execute('INSERT INTO replays (file, summary, details) VALUES (?, ?, ?)', (file, *self.dump(summary, details)))
+            self.connection.execute('DROP TABLE replays_old')
+
+
+    def upgrade_summaries(self):
+        """ Adds chat text to summaries saved before they had it """
+        with self.connection:
+            for file, summary, details in self.connection.execute('SELECT file, summary, details FROM replays WHERE details IS NOT NULL').fetchall():
+                try:
+                    summary = pickle.loads(summary)
+                    summary['chat'] = chat_text(pickle.loads(details).get('messages', list()))
+                    self.connection.execute('UPDATE replays SET summary = ? WHERE file = ?', (pickle.dumps(summary, protocol=pickle.HIGHEST_PROTOCOL), file))
+                except:
+                    logger.error(f'Failed to upgrade a cached replay\n{traceback.format_exc()}')
+            self.connection.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', ('summary_version', pickle.dumps(summary_version)))
+
+
+    @staticmethod
+    def dump(summary, details):
+        summary = pickle.dumps(summary, protocol=pickle.HIGHEST_PROTOCOL)
+        details = None if details == None else pickle.dumps(details, protocol=pickle.HIGHEST_PROTOCOL)
+        return summary, details
+
+
+    def close(self):
+        with self.lock:
+            if self.connection != None:
+                self.connection.close()
+                self.connection = None
+
+
+    def __len__(self):
+        with self.lock:
+            return self.connect().execute('SELECT COUNT(*) FROM replays').fetchone()[0]
+
+
+    def load(self):
+        """ Returns a list of all cached replays. Only summaries are loaded. """
+        with self.lock:
+            rows = self.connect().execute('SELECT summary FROM replays').fetchall()
+
+        replays = list()
+        for row in rows:
+            try:
+                replays.append(pickle.loads(row[0]))
+            except:
+                logger.error(f'Failed to load a cached replay\n{traceback.format_exc()}')
+        return replays
+
+
+    def load_details(self, files):
+        """ Returns a dictionary of details for given replays {file: details} """
+        files = list(files)
+        details = dict()
+
+        with self.lock:
+            connection = self.connect()
+            for i in range(0, len(files), 500):
+                chunk = files[i:i+500]
+                query = f'SELECT file, details FROM replays WHERE file IN ({",".join("?"*len(chunk))})'
+                for file, data in connection.execute(query, chunk):
+                    if data != None:
+                        details[file] = data
+
+        return {file:pickle.loads(data) for file, data in details.items()}
+
+
+    def save(self, replays):
+        """ Writes replays into the cache. Replaces previous records of the same replays.
+        Previously saved details are kept for replays without loaded details. """
+        rows = [(r['file'], *self.dump(*split_details(r))) for r in replays]
+        if len(rows) == 0:
+            return
+
+        with self.lock:
+            connection = self.connect()
+            with connection:
+                connection.executemany('INSERT INTO replays (file, summary, details) VALUES (?, ?, ?) '
+                                       'ON CONFLICT(file) DO UPDATE SET summary = excluded.summary, details = COALESCE(excluded.details, replays.details)', rows)
+        logger.debug(f'Saved {len(rows)} replays into the cache')
+
+
+    def get_meta(self, key):
+        """ Returns a value stored next to replays (e.g. aggregates calculated from them) or `None` """
+        with self.lock:
+            row = self.connect().execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        try:
+            return None if row == None else pickle.loads(row[0])
+        except:
+            logger.error(f'Failed to load {key} from the cache\n{traceback.format_exc()}')
+            return None
+
+
+    def set_meta(self, key, value):
+        """ Stores a value next to replays """
+        data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        with self.lock:
+            connection = self.connect()
+            with connection:
+                connection.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, data))
+
+
+    def compact(self, threshold=0.25):
+        """ Rebuilds the database if more than `threshold` of its pages are unused """
+        with self.lock:
+            connection = self.connect()
+            free = connection.execute('PRAGMA freelist_count').fetchone()[0]
+            total = connection.execute('PRAGMA page_count').fetchone()[0]
+            if total > 0 and free/total > threshold:
+                logger.info(f'Compacting replay cache ({free}/{total} pages unused)')
+                connection.execute('VACUUM')
+
+
+    def import_pickle(self, file):
+        """ Imports replays from the old cache format (a pickled list of all replays) and removes the old file """
+        if not os.path.isfile(file):
+            return
+
+        try:
+            with open(file, 'rb') as f:
+                replays = pickle.load(f)
+            self.save(replays)
+            os.remove(file)
+            logger.info(f'Imported {len(replays)} replays from the old cache')
+        except:
+            logger.error(f'Failed to import the old cache\n{traceback.format_exc()}')
@@ -0,0 +1,67 @@
+"""
+Replays ordered by their modification time.
+
+Replays can be accessed both by their path and their position. New replays are inserted
+at their sorted position, which is the end of the timeline for newly played games.
+
+"""
+import bisect
+
+
+class ReplayTimeline:
+    """ Replays sorted by modification time with their data {file: {'created': mtime, ...}} """
+
+    def __init__(self, replays=()):
+        self.files = list()
+        self.mtimes = list()
+        self.data = dict()
+        for file, mtime in sorted(replays, key=lambda x: x[1]):
+            self.add(file, mtime)
+
+
+    def __len__(self):
+        return len(self.files)
+
+
+    def __contains__(self, file):
+        return file in self.data
+
+
+    def __getitem__(self, file):
+        return self.data[file]
+
+
+    def __iter__(self):
+        return iter(self.files)
+
+
+    def items(self):
+        """ Yields (file, data) in order of modification time """
+        for file in self.files:
+            yield file, self.data[file]
+
+
+    def index(self, file):
+        """ Returns the current position of the replay. It's found by its modification time. """
+        position = bisect.bisect_left(self.mtimes, self.data[file]['created'])
+        while self.files[position] != file:
+            position += 1
+        return position
+
+
+    def add(self, file, mtime):
+        """ Adds a replay at its sorted position and returns the position """
+        if file in self.data:
+            return self.index(file)
+
+        position = bisect.bisect_right(self.mtimes, mtime)
+        self.files.insert(position, file)
+        self.mtimes.insert(position, mtime)
+        self.data[file] = {'created': mtime}
+        return position
+
+
+    def file_at(self, position):
+        """ Returns the replay at given position """
+        return self.files[position]
+
@@ -0,0 +1,151 @@
+"""
+Watches the account folder for new replays.
+
+Directories are cached with their modification times and subdirectories, and only directories
+whose modification time changed are listed again. Adding or renaming a file changes the modification
+time of its directory. On Windows the watcher waits for change notifications from the system,
+elsewhere it waits for a set time. New replays are reported once their size and modification time stop changing,
+so replays that are still being written aren't analysed.
+
+"""
+import os
+import time
+import traceback
+from collections import deque
+
+from SCOFunctions.MLogging import logclass
+
+logger = logclass('WTCH','INFO')
+
+FILE_NOTIFY_CHANGE_FILE_NAME = 0x1
+FILE_NOTIFY_CHANGE_DIR_NAME = 0x2
+FILE_NOTIFY_CHANGE_LAST_WRITE = 0x10
+WAIT_OBJECT_0 = 0x0
+
+# Use change notifications only on windows platform
+if os.name == 'nt':
+    import ctypes
+    import ctypes.wintypes
+    kernel32 = ctypes.windll.kernel32
+    kernel32.FindFirstChangeNotificationW.restype = ctypes.wintypes.HANDLE
+    kernel32.FindFirstChangeNotificationW.argtypes = (ctypes.wintypes.LPCWSTR, ctypes.wintypes.BOOL, ctypes.wintypes.DWORD)
+    kernel32.FindNextChangeNotification.argtypes = (ctypes.wintypes.HANDLE,)
+    kernel32.FindCloseChangeNotification.argtypes = (ctypes.wintypes.HANDLE,)
+    kernel32.WaitForSingleObject.argtypes = (ctypes.wintypes.HANDLE, ctypes.wintypes.DWORD)
+    kernel32.WaitForSingleObject.restype = ctypes.wintypes.DWORD
+    INVALID_HANDLE_VALUE = ctypes.wintypes.HANDLE(-1).value
+else:
+    kernel32 = None
+    INVALID_HANDLE_VALUE = None
+    logger.info("Not a Windows operation system, won't use change notifications")
+
+
+def replay_path(directory, file):
+    """ Returns normalized replay path in the same format as used in AllReplays """
+    file_path = os.path.join(directory, file)
+    if len(file_path) > 255:
+        file_path = '\\\?\\' + file_path
+    return os.path.normpath(file_path)
+
+
+class ReplayWatcher:
+    """ Finds new replays in a folder and its subfolders """
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.directories = dict() # {directory: (mtime, subdirectories)}
+        self.replays = set()
+        self.pending = dict() # New replays waiting for their size and mtime to settle {path: (size, mtime)}
+        self.found = deque() # New replays that weren't processed yet
+        self.scanned = False
+        self.handle = None
+        self.notifications = kernel32 != None
+
+
+    def _list_directory(self, directory, new_replays):
+        """ Lists the directory and adds new replays. Returns its subdirectories. """
+        subdirectories = list()
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    subdirectories.append(entry.path)
+                elif entry.name.endswith('.SC2Replay'):
+                    path = replay_path(directory, entry.name)
+                    if not path in self.replays:
+                        self.replays.add(path)
+                        new_replays.append(path)
+        return subdirectories
+
+
+    def scan(self):
+        """ Adds new replays to `found`. The first scan finds all replays. """
+        new_replays = list()
+        to_check = [self.folder]
+        while len(to_check) > 0:
+            directory = to_check.pop()
+            try:
+                mtime = os.stat(directory).st_mtime
+                if directory in self.directories and self.directories[directory][0] == mtime:
+                    subdirectories = self.directories[directory][1]
+                else:
+                    subdirectories = self._list_directory(directory, new_replays)
+                    self.directories[directory] = (mtime, subdirectories)
+                to_check.extend(subdirectories)
+            except OSError:
+                self.directories.pop(directory, None)
+
+        if not self.scanned:
+            self.scanned = True
+            self.found.extend(new_replays)
+            return
+
+        # New replays wait at least one scan for their size and mtime to settle
+        for path in list(self.pending) + new_replays:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                self.pending.pop(path, None)
+                self.replays.discard(path)
+                continue
+
+            state = (stat.st_size, stat.st_mtime)
+            if stat.st_size > 0 and self.pending.get(path) == state:
+                del self.pending[path]
+                self.found.append(path)
+            else:
+                self.pending[path] = state
+
+
+    def wait(self, timeout):
+        """ Waits until something changes in the folder or `timeout` seconds pass.
+        Returns False if nothing changed, True if something might have changed. """
+        if not self.notifications:
+            time.sleep(timeout)
+            return True
+
+        try:
+            if self.handle == None:
+                self.handle = kernel32.FindFirstChangeNotificationW(self.folder, True, FILE_NOTIFY_CHANGE_FILE_NAME | FILE_NOTIFY_CHANGE_DIR_NAME | FILE_NOTIFY_CHANGE_LAST_WRITE)
+                if self.handle == INVALID_HANDLE_VALUE:
+                    self.handle = None
+                    raise OSError(f'Failed to watch {self.folder}')
+                # Changes before notifications started aren't reported
+                return True
+
+            if kernel32.WaitForSingleObject(self.handle, int(timeout*1000)) == WAIT_OBJECT_0:
+                kernel32.FindNextChangeNotification(self.handle)
+                return True
+            return False
+        except:
+            logger.error(f'Failed to wait for changes, falling back to polling\n{traceback.format_exc()}')
+            self.close()
+            self.notifications = False
+            time.sleep(timeout)
+            return True
+
+
+    def close(self):
+        """ Stops watching for change notifications """
+        if self.handle != None:
+            kernel32.FindCloseChangeNotification(self.handle)
+        self.handle = None
@@ -0,0 +1,95 @@
+"""
+Polls the SC2 client API (http://localhost:6119/game) for the current game.
+
+A single session keeps the connection to the game alive between requests. The polling interval adapts
+to the state of the game. It's short in the first seconds of a game and on the loading screen,
+longer in menus and replays, and it keeps growing while the game isn't running.
+Request latency and errors are counted and can be logged or shown.
+
+"""
+import time
+import traceback
+
+import requests
+
+from SCOFunctions.MLogging import logclass
+
+logger = logclass('SC2C','INFO')
+
+
+class SC2ClientPoller:
+    """ Polls the SC2 client API with adaptive intervals """
+
+    def __init__(self, url='http://localhost:6119/game', timeout=(0.5, 2), fast_interval=0.5, slow_interval=2, max_interval=8, start_window=15):
+        self.url = url
+        self.timeout = timeout # (connect, read) timeouts in seconds
+        self.fast_interval = fast_interval # Around game start
+        self.slow_interval = slow_interval # In menus, replays and during games
+        self.max_interval = max_interval # Limit for backoff while the game isn't running
+        self.start_window = start_window # Game time (seconds) that counts as game start
+        self.interval = fast_interval
+        self.session = requests.Session()
+        self.last_display_time = None
+        self.counters = {'requests': 0, 'errors': 0, 'connection_errors': 0, 'timeouts': 0, 'json_errors': 0, 'latency_total': 0, 'latency_max': 0}
+
+
+    def poll(self):
+        """ Returns the response from the game or `None` if the request failed. Updates polling interval. """
+        self.counters['requests'] += 1
+        start = time.perf_counter()
+        try:
+            resp = self.session.get(self.url, timeout=self.timeout).json()
+            self.update_interval(resp)
+            return resp
+
+        except requests.exceptions.ConnectionError:
+            self.counters['connection_errors'] += 1
+            logger.debug('SC2 request failed. Game not running.')
+        except requests.exceptions.Timeout:
+            self.counters['timeouts'] += 1
+            logger.info('SC2 request timeout')
+        except ValueError:
+            self.counters['json_errors'] += 1
+            logger.info('SC2 request json decoding failed (SC2 is starting or closing)')
+        except:
+            logger.info(traceback.format_exc())
+        finally:
+            latency = time.perf_counter() - start
+            self.counters['latency_total'] += latency
+            self.counters['latency_max'] = max(self.counters['latency_max'], latency)
+
+        # Back off while the game isn't responding
+        self.counters['errors'] += 1
+        self.interval = min(self.max_interval, max(self.slow_interval, self.interval * 2))
+        return None
+
+
+    def update_interval(self, resp):
+        """ Polls fast on the loading screen and while the game time is in the game start window """
+        display_time = resp.get('displayTime', 0)
+        in_game = len(resp.get('players', list())) > 0 and not resp.get('isReplay', True)
+        time_changed = self.last_display_time != display_time
+        self.last_display_time = display_time
+
+        if in_game and (display_time == 0 or (time_changed and display_time < self.start_window)):
+            self.interval = self.fast_interval
+        else:
+            self.interval = self.slow_interval
+
+
+    def wait(self, should_stop=None):
+        """ Waits for the current interval. Returns early when `should_stop()` is True. """
+        end = time.time() + self.interval
+        while time.time() < end:
+            time.sleep(min(0.5, max(0, end - time.time())))
+            if should_stop != None and should_stop():
+                return
+
+
+    def stats(self):
+        """ Returns request counters with average latency in milliseconds """
+        stats = dict(self.counters)
+        stats['latency_avg_ms'] = round(1000 * stats['latency_total'] / max(1, stats['requests']), 2)
+        stats['latency_max_ms'] = round(1000 * stats['latency_max'], 2)
+        stats['interval'] = self.interval
+        return stats
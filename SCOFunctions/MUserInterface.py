@@ -1025,7 +1025,10 @@ class GameEntry:
         self.file = replay_dict['file']
         self.date = replay_dict['date'][:10].replace(':','-') + ' ' + replay_dict['date'][11:16]
         self.chat_showing = False
-        self.message_count = len(replay_dict['messages'])
+        self.chat_loaded = False
+        self.messages = replay_dict.get('messages')
+        self.players = replay_dict['players']
+        self.testplayer = 2 if replay_dict['players'][1]['handle'] in handles else 1
 
         if replay_dict['players'][1]['handle'] in handles:
             self.p1_name = replay_dict['players'][1]['name']
@@ -1112,33 +1115,45 @@ class GameEntry:
         self.BT_file.clicked.connect(lambda: find_file(self.file))
 
         self.la_chat = QtWidgets.QLabel(self.widget)
-        self.la_chat.setGeometry(QtCore.QRect(20, 35, 500, 10+14*self.message_count))
+        self.la_chat.setGeometry(QtCore.QRect(20, 35, 500, 10))
         self.la_chat.setAlignment(QtCore.Qt.AlignTop)
+        self.la_chat.hide()
+
+        # Styling
+        for item in {self.la_chat, self.la_mapname, self.la_result, self.la_p1, self.la_p2, self.la_enemy, self.la_length, self.la_difficulty, self.la_date}:
+            item.setTextInteractionFlags(QtCore.Qt.TextSelectableByMouse)
+            if self.result == 'Defeat':
+                item.setStyleSheet('color: red')
 
-        testplayer = 2 if replay_dict['players'][1]['handle'] in handles else 1
+
+    def load_chat(self):
+        """ Fills chat messages. They are loaded from the cache if the replay came without them. """
+        if self.messages == None:
+            replay = MF.CAnalysis.get_details(self.file) if MF.CAnalysis != None else None
+            self.messages = replay.get('messages', list()) if replay != None else list()
+
+        self.message_count = len(self.messages)
+        self.la_chat.setGeometry(QtCore.QRect(20, 35, 500, 10+14*self.message_count))
 
         text = ''
-        for message in replay_dict['messages']:
-            color = '#338F00' if message['player'] == testplayer else 'blue'
+        for message in self.messages:
+            color = '#338F00' if message['player'] == self.testplayer else 'blue'
             if message['time'] >= 3600:
                 t = time.strftime('%H:%M:%S', time.gmtime(message['time']))
             else:
                 t = time.strftime('%M:%S', time.gmtime(message['time']))
             style = f'style="color: {color}"'
-            text += f"<span {style}>{t}&nbsp;&nbsp;<b>{replay_dict['players'][message['player']]['name']}</b>:&nbsp;&nbsp;{message['text']}</span><br>"
+            text += f"<span {style}>{t}&nbsp;&nbsp;<b>{self.players[message['player']]['name']}</b>:&nbsp;&nbsp;{message['text']}</span><br>"
 
         self.la_chat.setText(text)
-        self.la_chat.hide()
-
-        # Styling
-        for item in {self.la_chat, self.la_mapname, self.la_result, self.la_p1, self.la_p2, self.la_enemy, self.la_length, self.la_difficulty, self.la_date}:
-            item.setTextInteractionFlags(QtCore.Qt.TextSelectableByMouse)
-            if self.result == 'Defeat':
-                item.setStyleSheet('color: red')
+        self.chat_loaded = True
 
 
     def show_chat(self):
         """ Shows/hides chat """       
+        if not self.chat_loaded:
+            self.load_chat()
+
         if self.chat_showing:
             self.chat_showing = False
             height = 30
@@ -1398,7 +1413,7 @@ class CustomWebView(QtWebEngineWidgets.QWebEngineView):
     def on_load_finished(self,ok):
         if ok:
             self.page().runJavaScript(f"do_not_use_websocket = true;")
-            MF.resend_init_message()
+            MF.reset_webpage()
 
 
 class PatchNotes(QtWidgets.QWidget):
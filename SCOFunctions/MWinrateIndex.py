@@ -0,0 +1,121 @@
+"""
+Per-player aggregates for player winrates.
+
+Each player has running counts of wins and losses, a histogram of APM values and commander counts.
+Adding a replay only updates its two players. Rows for the player tab (median APM, most played commander)
+are recalculated only for players changed since the last call, but all rows are still sorted and copied on each call.
+
+"""
+import threading
+from collections import Counter
+
+
+def histogram_median(histogram):
+    """ Returns the median of values in a histogram {value: count}. Same as `statistics.median`. """
+    total = sum(histogram.values())
+    if total == 0:
+        return 0
+
+    lower_idx = (total - 1) // 2
+    upper_idx = total // 2
+    lower = upper = None
+    seen = 0
+    for value in sorted(histogram):
+        seen += histogram[value]
+        if lower == None and seen > lower_idx:
+            lower = value
+        if seen > upper_idx:
+            upper = value
+            break
+
+    return lower if lower_idx == upper_idx else (lower + upper) / 2
+
+
+class WinrateIndex:
+    """ Player winrate aggregates {player: [wins, losses, APM histogram, commander counts]} """
+
+    version = 1
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self._reset()
+
+
+    def _reset(self):
+        self.players = dict()
+        self.files = set() # Replays included
+        self.rows = dict() # Calculated rows {player: [wins, losses, apm, commander, commander frequency]}
+        self.dirty = set() # Players changed since their rows were calculated
+        self.changed = False # Changed since the last save
+
+
+    def add(self, replay):
+        """ Adds the replay to aggregates. Replays already included are skipped. """
+        with self.lock:
+            if replay['file'] in self.files:
+                return
+            self.files.add(replay['file'])
+            self.changed = True
+
+            for p in {1,2}:
+                player = replay['players'][p]['name']
+                if not player in self.players:
+                    self.players[player] = [0, 0, Counter(), Counter()]
+
+                stats = self.players[player]
+                if replay['result'] == 'Victory':
+                    stats[0] += 1
+                else:
+                    stats[1] += 1
+                stats[2][replay['players'][p]['apm']] += 1
+                stats[3][replay['players'][p]['commander']] += 1
+                self.dirty.add(player)
+
+
+    def rebuild(self, replays):
+        """ Builds aggregates from scratch """
+        with self.lock:
+            self._reset()
+            for replay in replays:
+                self.add(replay)
+            self.changed = True
+
+
+    def row(self, player):
+        """ Returns [wins, losses, median apm, most played commander, its frequency] """
+        wins, losses, apm, commanders = self.players[player]
+        if len(commanders) > 0:
+            commander, count = commanders.most_common(1)[0]
+            frequency = count / sum(commanders.values())
+        else:
+            commander, frequency = '', 0
+        return [wins, losses, histogram_median(apm), commander, frequency]
+
+
+    def winrate_data(self):
+        """ Returns player winrate data sorted by wins. Only rows of changed players are recalculated. """
+        with self.lock:
+            for player in self.dirty:
+                self.rows[player] = self.row(player)
+            self.dirty = set()
+            return {k:list(self.rows[k]) for k in sorted(self.players, key=lambda x:self.rows[x][0], reverse=True)}
+
+
+    def get_state(self):
+        """ Returns a copy of aggregates for saving """
+        with self.lock:
+            self.changed = False
+            players = {k:[v[0], v[1], Counter(v[2]), Counter(v[3])] for k,v in self.players.items()}
+            return {'version': self.version, 'files': set(self.files), 'players': players}
+
+
+    def set_state(self, state):
+        """ Loads saved aggregates. Returns False if they are from a different version. """
+        if not isinstance(state, dict) or state.get('version') != self.version:
+            return False
+        with self.lock:
+            self._reset()
+            self.files = state['files']
+            self.players = state['players']
+            self.dirty = set(self.players)
+        return True
@@ -1,27 +1,34 @@
 import os
 import json
 import time
+import queue
 import threading
 import traceback
+import concurrent.futures
 
 import requests
 import asyncio
 import keyboard
 import websockets
 
-from SCOFunctions.MFilePath import truePath
 from SCOFunctions.MLogging import logclass
-from SCOFunctions.ReplayAnalysis import analyse_replay
-
-
-OverlayMessages = [] # Storage for all messages
-globalOverlayMessagesSent = 0 # Global variable to keep track of messages sent. Useful when opening new overlay instances later.
+from SCOFunctions.MBroadcastHub import BroadcastHub
+from SCOFunctions.MNegativeCache import negative_cache, ANALYSE
+from SCOFunctions.MOverlayProtocol import ReplayReferences, full_payload, reference_payload
+from SCOFunctions.MOverlayStore import overlay_store
+from SCOFunctions.MReplayTimeline import ReplayTimeline
+from SCOFunctions.MReplayWatcher import ReplayWatcher
+from SCOFunctions.MSC2Client import SC2ClientPoller
+from SCOFunctions.ReplayAnalysis import analyse_replay, ANALYSIS_VERSION
+
+
+hub = BroadcastHub() # Sends messages to websocket clients
+webpage_references = ReplayReferences() # Replays cached by the primary overlay
 lock = threading.Lock()
 logger = logclass('MAIN','INFO')
 initMessage = {'initEvent':True,'colors':['null','null','null','null'],'duration':60}
-analysis_log_file = truePath('cache_replay_analysis.txt')
 ReplayPosition = 0
-AllReplays = dict()
+AllReplays = ReplayTimeline()
 player_winrate_data = dict()
 PLAYER_HANDLES = set() # Set of handles of the main player
 PLAYER_NAMES = set() # Set of names of the main player generated from handles and used in winrate notification
@@ -32,6 +39,21 @@ APP_CLOSING = False
 session_games = {'Victory':0,'Defeat':0}
 WEBPAGE = None
 RNG_COMMANDER = dict()
+replay_watcher = None
+
+# Queues between stages of new replay handling
+analysis_queue = queue.Queue() # New replays that finished writing
+persist_queue = queue.Queue() # Analysed replays to save
+upload_queue = queue.Queue() # Analysed replays to upload
+new_games = queue.Queue() # Analysed replays returned from `check_replays`
+pipeline_started = False
+
+# Replays ahead of the overlay position are analysed in background
+prefetch_queue = queue.Queue() # Positions to prefetch from (position, delta)
+prefetch_count = 3
+prefetcher_started = False
+analysis_lock = threading.Lock() # Guards `analyses_in_progress`
+analyses_in_progress = dict() # Replays being analysed, so the same replay isn't analysed twice {file: Future}
 
 
 def stop_threads():
@@ -53,21 +75,15 @@ def update_settings(d):
 def sendEvent(event):
     """ Send message to the overlay """
 
-    global globalOverlayMessagesSent
-
-    with lock:
-        # Update global messages. So a new socket doesn't get all previous once at once.
-        globalOverlayMessagesSent += 1
-        # Websocket connection for non-primary overlay
-        OverlayMessages.append(event)
+    # Websocket connection for non-primary overlay
+    hub.publish(event)
 
     # Send message directly thorugh javascript for the primary overlay.
     if WEBPAGE == None:
         return
         
     elif event.get('replaydata') != None:
-        data = json.dumps(event)
-        WEBPAGE.runJavaScript(f"postGameStatsTimed({data});")
+        show_on_webpage(event)
 
     elif event.get('mutatordata') != None:
         data = json.dumps(event)
@@ -95,6 +111,31 @@ def sendEvent(event):
         WEBPAGE.runJavaScript(f"showHidePlayerWinrate({data})")    
         
 
+def show_on_webpage(event):
+    """ Sends replay analysis to the primary overlay. The overlay returns whether it showed the replay.
+    Replays it showed are cached there, if it didn't find a referenced replay it gets the full replay. """
+    file = event.get('filepath')
+    reference = webpage_references.cached(file)
+    data = json.dumps(reference_payload(event) if reference else full_payload(event))
+
+    def shown(result):
+        if result == True:
+            webpage_references.confirm(file)
+            return
+        webpage_references.forget(file)
+        if reference:
+            logger.info(f'Replay not cached by the overlay, sending it in full: {file}')
+            show_on_webpage(event)
+
+    WEBPAGE.runJavaScript(f"postGameStatsTimed({data});", shown)
+
+
+def reset_webpage():
+    """ Called when the primary overlay is loaded. Its replay cache is empty and the init message is resent. """
+    webpage_references.clear()
+    resend_init_message()
+
+
 def resend_init_message():
     """ Resends init message. In case duration of colors have changed. """
     sendEvent(initMessage)
@@ -131,8 +172,9 @@ def find_names_and_handles(ACCOUNTDIR, replays=None):
         logger.info(f'No player names found, falling back to settings: {names}')
 
     if len(names) == 0 and len(handles) > 0 and replays != None:
-        replays = [v.get('replay_dict', {'parser':None}).get('parser',None) for k,v in replays.items() if v!=None]
-        replays = [r for r in replays if r != None]
+        # Read stored replays one by one until all handles are found
+        replays = (r.get('parser',None) for k,r in overlay_store.items() if k in replays)
+        replays = (r for r in replays if r != None)
         names = names_fallback(handles, replays)
         logger.info(f'No player names found, falling back to replays: {names}')
 
@@ -198,25 +240,21 @@ def find_replays(directory):
 
 
 def initialize_AllReplays(ACCOUNTDIR):
-    """ Creates a sorted dictionary of all replays with their last modified times """
+    """ Creates a sorted dictionary of all replays with their last modified times.
+    Replay analysis isn't loaded here, it's read from the overlay store when a replay is shown. """
     
     try:
         AllReplays = find_replays(ACCOUNTDIR)
         # Get dictionary of all replays with their last modification time
-        AllReplays = ((rep,os.path.getmtime(rep)) for rep in AllReplays)
-        AllReplays = {k:{'created':v} for k,v in sorted(AllReplays,key=lambda x:x[1])}
-
-        # Append data from already parsed replays
-        if os.path.isfile(analysis_log_file):
-            with open(analysis_log_file,'rb') as file:
-                for line in file.readlines():
-                    try:
-                        replay_dict = eval(line.decode('utf-8'))
-                        if 'replaydata' in replay_dict and 'filepath' in replay_dict:
-                            if replay_dict['filepath'] in AllReplays:
-                                AllReplays[replay_dict['filepath']]['replay_dict'] = replay_dict
-                    except:
-                        logger.error("Failed to parse a line from replay analysis log\n",traceback.format_exc())
+        AllReplays = ReplayTimeline((rep,os.path.getmtime(rep)) for rep in AllReplays)
+
+        # Index already analysed replays
+        overlay_store.load()
+
+        # Skip replays that failed to be analysed before
+        for file, data in AllReplays.items():
+            if not file in overlay_store and negative_cache.is_failed(file, kinds=(ANALYSE,), version=ANALYSIS_VERSION, mtime=data['created']):
+                data['failed'] = True
 
     except:
         logger.error(f'Error during replay initialization\n{traceback.format_exc()}')
@@ -251,71 +289,127 @@ def check_names_handles():
         logger.error(f'Error when finding player handles:\n{traceback.format_exc()}')
 
 
-def check_replays():
-    """ Checks every few seconds for new replays """
-    global AllReplays
-    global session_games
-    global ReplayPosition
+def queue_items(q):
+    """ Yields items from the queue until the app is closing """
+    while not APP_CLOSING:
+        try:
+            yield q.get(timeout=0.5)
+        except queue.Empty:
+            pass
+
+
+def detect_replays():
+    """ Pipeline stage that waits for new replays and passes them for analysis once they are written """
+    global replay_watcher
+    changed = True
+    while not APP_CLOSING:
+        if replay_watcher == None or replay_watcher.folder != SETTINGS['account_folder']:
+            if replay_watcher != None:
+                replay_watcher.close()
+            replay_watcher = ReplayWatcher(SETTINGS['account_folder'])
+            changed = True
 
-    while True:
-        logger.debug('Checking for replays....')
         # Check for new replays
+        if changed or len(replay_watcher.pending) > 0:
+            logger.debug('Checking for replays....')
+            replay_watcher.scan()
+
         current_time = time.time()
-        for root, directories, files in os.walk(SETTINGS['account_folder']):
-            for file in files:
-                file_path = os.path.join(root,file)
-                if len(file_path) > 255:
-                    file_path = '\\\?\\' + file_path
-                file_path = os.path.normpath(file_path)
-                if file.endswith('.SC2Replay') and not(file_path in AllReplays):
-                    with lock:
-                        AllReplays[file_path] = {'created':os.path.getmtime(file_path)}
-
-                    if current_time - os.path.getmtime(file_path) < 60:
-                        logger.info(f'New replay: {file_path}')
-                        replay_dict = dict()
-                        try:
-                            replay_dict = analyse_replay(file_path,PLAYER_HANDLES)
-
-                            # Good output
-                            if len(replay_dict) > 1:
-                                logger.debug('Replay analysis result looks good, appending...')
-                                with lock:
-                                    session_games[replay_dict['result']] += 1
-
-                                # What to send
-                                out = replay_dict.copy()
-                                if SETTINGS.get('show_session',False):
-                                    out.update(session_games)
-                                if SETTINGS.get('show_random_on_overlay',False) and len(RNG_COMMANDER) > 0:
-                                    out.update(RNG_COMMANDER)
-                                sendEvent(out)
-
-                                with open(analysis_log_file, 'ab') as file: #save into a text file
-                                    file.write((str(replay_dict)+'\n').encode('utf-8'))
-                            # No output
-                            else:
-                                logger.error(f'ERROR: No output from replay analysis ({file})')
-
-                            with lock:
-                                AllReplays[file_path]['replay_dict'] = replay_dict
-                                ReplayPosition = len(AllReplays)-1
-
-                        except:
-                            logger.error(traceback.format_exc())
-
-                        finally:
-                            if len(replay_dict) > 1:
-                                upload_to_aom(file_path,replay_dict)
-                                # return just parser 
-                                return replay_dict
-
-
-        # Wait while checking if the thread should end early
-        for i in range(6):
-            time.sleep(0.5)
-            if APP_CLOSING:
-                return None
+        while len(replay_watcher.found) > 0:
+            file_path = replay_watcher.found.popleft()
+            if file_path in AllReplays:
+                continue
+
+            try:
+                mtime = os.path.getmtime(file_path)
+            except OSError:
+                continue
+
+            with lock:
+                AllReplays.add(file_path, mtime)
+
+            if current_time - mtime < 60:
+                logger.info(f'New replay: {file_path}')
+                analysis_queue.put(file_path)
+
+        # Wait for changes while checking if the thread should end early
+        changed = replay_watcher.wait(0.5)
+
+    replay_watcher.close()
+
+
+def analyse_new_replays():
+    """ Pipeline stage that analyses new replays and shows them on the overlay """
+    global session_games
+    global ReplayPosition
+
+    for file_path in queue_items(analysis_queue):
+        replay_dict = dict()
+        try:
+            replay_dict = analyse_replay(file_path,PLAYER_HANDLES)
+        except:
+            logger.error(traceback.format_exc())
+
+        # Other replays might have been added before this one since it was detected
+        with lock:
+            ReplayPosition = AllReplays.index(file_path)
+
+        # No output
+        if len(replay_dict) <= 1:
+            logger.error(f'ERROR: No output from replay analysis ({file_path})')
+            with lock:
+                AllReplays[file_path]['failed'] = True
+            continue
+
+        # Good output
+        logger.debug('Replay analysis result looks good, sending...')
+        with lock:
+            session_games[replay_dict['result']] += 1
+
+        # What to send
+        out = replay_dict.copy()
+        if SETTINGS.get('show_session',False):
+            out.update(session_games)
+        if SETTINGS.get('show_random_on_overlay',False) and len(RNG_COMMANDER) > 0:
+            out.update(RNG_COMMANDER)
+        sendEvent(out)
+
+        # Saving and uploading doesn't delay showing stats
+        persist_queue.put(replay_dict)
+        upload_queue.put(replay_dict)
+        new_games.put(replay_dict)
+
+
+def persist_replays():
+    """ Pipeline stage that saves analysed replays into the overlay store """
+    for replay_dict in queue_items(persist_queue):
+        overlay_store.put(replay_dict['filepath'], replay_dict)
+
+
+def upload_replays():
+    """ Pipeline stage that uploads analysed replays """
+    for replay_dict in queue_items(upload_queue):
+        upload_to_aom(replay_dict['filepath'], replay_dict)
+
+
+def start_replay_pipeline():
+    """ Starts a thread for each stage of handling new replays """
+    global pipeline_started
+    with lock:
+        if pipeline_started:
+            return
+        pipeline_started = True
+
+    for stage in (detect_replays, analyse_new_replays, persist_replays, upload_replays):
+        threading.Thread(target=stage, daemon=True).start()
+
+
+def check_replays():
+    """ Waits for a new replay to be analysed and returns its analysis """
+    start_replay_pipeline()
+    for replay_dict in queue_items(new_games):
+        return replay_dict
+    return None
 
 
 def upload_to_aom(file_path, replay_dict):
@@ -348,79 +442,90 @@ def upload_to_aom(file_path, replay_dict):
         logger.error(f'Failed to upload replay\n{traceback.format_exc()}')
 
 
-def show_overlay(file):
-    """ Shows overlay. If it wasn't analysed before, analyse now."""
+def get_replay_dict(file):
+    """ Returns analysis of the replay from the overlay store. If it wasn't analysed before, analyse now.
+    Returns `None` if the replay couldn't be analysed. If the replay is being analysed in another thread
+    (e.g. by the prefetcher), waits for that analysis. Analyses of other replays don't block. """
+
+    if AllReplays[file].get('failed', False):
+        logger.info(f"This replay couldn't be analysed {file}")
+        return None
 
     # Replay already analysed
-    if 'replay_dict' in AllReplays[file]:
-        if AllReplays[file]['replay_dict'] != None:
-            sendEvent(AllReplays[file]['replay_dict'])
+    replay_dict = overlay_store.get(file)
+    if replay_dict != None:
+        return replay_dict
+
+    # Replay_dict is missing, analyse replay unless it's already being analysed
+    with analysis_lock:
+        future = analyses_in_progress.get(file)
+        if future == None:
+            future = concurrent.futures.Future()
+            analyses_in_progress[file] = future
+            analysing = True
         else:
-            logger.info(f"This replay couldn't be analysed {file}")
+            analysing = False
 
-    # Replay_dict is missing, analyse replay
-    else:
-        try:
-            replay_dict = analyse_replay(file, PLAYER_HANDLES)
-            if len(replay_dict) > 1:
-                sendEvent(replay_dict)
-                with lock:
-                    AllReplays[file]['replay_dict'] = replay_dict
-                with open(analysis_log_file, 'ab') as file:
-                    file.write((str(replay_dict)+'\n').encode('utf-8'))
-                if CAnalysis != None:
-                    CAnalysis.add_parsed_replay(replay_dict)  
-                    
-            # No output from analysis
-            else:
-                with lock:
-                    AllReplays[file]['replay_dict'] = None
-        except:
-            logger.error(f'Failed to analyse replay: {file}\n{traceback.format_exc()}')
-            with lock:
-                AllReplays[file]['replay_dict'] = None
+    if not analysing:
+        return future.result()
+
+    replay_dict = None
+    try:
+        replay_dict = analyse_for_overlay(file)
+    finally:
+        with analysis_lock:
+            del analyses_in_progress[file]
+        future.set_result(replay_dict)
+    return replay_dict
+
+
+def analyse_for_overlay(file):
+    """ Analyses the replay and saves the result into the overlay store. Returns `None` if it couldn't be analysed. """
+
+    # The replay might have been analysed by another thread in the meantime
+    if AllReplays[file].get('failed', False):
+        return None
+    replay_dict = overlay_store.get(file)
+    if replay_dict != None:
+        return replay_dict
+
+    try:
+        replay_dict = analyse_replay(file, PLAYER_HANDLES)
+        if len(replay_dict) > 1:
+            overlay_store.put(file, replay_dict)
+            if CAnalysis != None:
+                CAnalysis.add_parsed_replay(replay_dict)
+            return replay_dict
+        reason = 'no output'
+    except Exception as e:
+        logger.error(f'Failed to analyse replay: {file}\n{traceback.format_exc()}')
+        reason = type(e).__name__
+
+    with lock:
+        AllReplays[file]['failed'] = True
+    negative_cache.add(file, reason, kind=ANALYSE, version=ANALYSIS_VERSION, mtime=AllReplays[file]['created'])
+    negative_cache.save()
+    return None
+
+
+def show_overlay(file):
+    """ Shows overlay. If it wasn't analysed before, analyse now."""
+    replay_dict = get_replay_dict(file)
+    if replay_dict != None:
+        sendEvent(replay_dict)
 
 
 async def manager(websocket, path):
     """ Manages websocket connection for each client """
-    overlayMessagesSent = globalOverlayMessagesSent
     logger.info(f"Starting: {websocket}\nSending init message: {initMessage}")
-    await websocket.send(json.dumps(initMessage))
-    while True:
-        try:
-            if len(OverlayMessages) > overlayMessagesSent:
-                message = json.dumps(OverlayMessages[overlayMessagesSent])
-                overlayMessagesSent += 1
-                logger.info(f'#{overlayMessagesSent-1} message is being sent through {websocket}')
-
-                try: # Send the message
-                    await asyncio.wait_for(asyncio.gather(websocket.send(message)), timeout=1)
-                    logger.info(f'#{overlayMessagesSent-1} message sent')
-
-                except asyncio.TimeoutError:
-                    logger.error(f'#{overlayMessagesSent-1} message was timed-out.')
-                except websockets.exceptions.ConnectionClosedOK:
-                    logger.info('Websocket connection closed (ok).')
-                    break
-                except websockets.exceptions.ConnectionClosedError:
-                    logger.info('Websocket connection closed (error).')
-                    break
-                except websockets.exceptions.ConnectionClosed:
-                    logger.info('Websocket connection closed.')
-                    break
-                except:
-                    logger.error(traceback.format_exc())
-
-        except:
-            logger.error(traceback.format_exc())
-        finally:
-            await asyncio.sleep(0.1)
+    await hub.serve(websocket, init=initMessage)
 
 
 def server_thread(PORT=7305):
     """ Creates a websocket server """
     loop = asyncio.new_event_loop()
     asyncio.set_event_loop(loop)
+    hub.start(loop, replay_source=get_replay_dict)
     try:
         start_server = websockets.serve(manager, 'localhost', PORT)
         logger.info('Starting websocket server')
@@ -431,49 +536,57 @@ def server_thread(PORT=7305):
 
 
 def move_in_AllReplays(delta):
-    """ Moves across all replays and sends info to overlay to show parsed data """
+    """ Moves across all replays and sends info to overlay to show parsed data. Replays that can't be analysed are skipped.
+    The position moves over them too, so it stays at the last replay checked. """
     global ReplayPosition
     logger.info(f'Attempt to move to {ReplayPosition + delta}/{len(AllReplays)-1}')
 
-    # Check if valid position
     newPosition = ReplayPosition + delta
-    if newPosition < 0 or newPosition >= len(AllReplays):
-        logger.info(f'We have gone too far. Staying at {ReplayPosition}')
+    while 0 <= newPosition < len(AllReplays):
+        with lock:
+            ReplayPosition = newPosition
+
+        # Get replay_dict of given replay
+        key = AllReplays.file_at(newPosition)
+        replay_dict = get_replay_dict(key)
+        if replay_dict == None:
+            newPosition += delta
+            continue
+
+        sendEvent(replay_dict)
+
+        # Prefetch next replays in the direction of movement
+        start_prefetcher()
+        prefetch_queue.put((newPosition, delta))
         return
 
-    with lock:
-        ReplayPosition = newPosition
+    logger.info(f'We have gone too far. Staying at {ReplayPosition}')
+
+
+def prefetch_replays():
+    """ Analyses or loads replays ahead of the overlay position, so moving to them doesn't wait for analysis """
+    for position, delta in queue_items(prefetch_queue):
+        # Only the latest position matters
+        while not prefetch_queue.empty():
+            position, delta = prefetch_queue.get()
+
+        for i in range(1, prefetch_count+1):
+            if position + delta*i < 0 or position + delta*i >= len(AllReplays) or not prefetch_queue.empty():
+                break
+            try:
+                get_replay_dict(AllReplays.file_at(position + delta*i))
+            except:
+                logger.error(f'Failed to prefetch a replay\n{traceback.format_exc()}')
 
-    # Get replay_dict of given replay
-    key = list(AllReplays.keys())[ReplayPosition]
-    if 'replay_dict' in AllReplays[key]:
-        if AllReplays[key]['replay_dict'] != None:
-            sendEvent(AllReplays[key]['replay_dict'])
-        else:
-            logger.info(f"This replay couldn't be analysed {key}")
-            move_in_AllReplays(delta)
-    else:
-        # Replay_dict is missing, analyse replay
-        try:
-            replay_dict = analyse_replay(key,PLAYER_HANDLES)
-            if len(replay_dict) > 1:
-                sendEvent(replay_dict)
-                with lock:
-                    AllReplays[key]['replay_dict'] = replay_dict
-                with open(analysis_log_file, 'ab') as file:
-                    file.write((str(replay_dict)+'\n').encode('utf-8'))
-                if CAnalysis != None:
-                    CAnalysis.add_parsed_replay(replay_dict)  
-            else:
-                # No output from analysis
-                with lock:
-                    AllReplays[key]['replay_dict'] = None
-                move_in_AllReplays(delta)
-        except:
-            logger.error(f'Failed to analyse replay: {key}\n{traceback.format_exc()}')
-            with lock:
-                AllReplays[key]['replay_dict'] = None
-            move_in_AllReplays(delta)
+
+def start_prefetcher():
+    """ Starts a thread prefetching replays """
+    global prefetcher_started
+    with lock:
+        if prefetcher_started:
+            return
+        prefetcher_started = True
+    threading.Thread(target=prefetch_replays, daemon=True).start()
 
 
 def keyboard_OLDER():
@@ -552,13 +665,21 @@ def check_for_new_game():
     last_replay_amount = 0
     last_replay_amount_flowing = len(AllReplays) # This helps identify when a replay has been parsed
     last_replay_time = 0 # Time when we got the last replay parsed
+    poller = SC2ClientPoller()
+    last_stats_logged = time.time()
 
     while True:
-        time.sleep(0.5)
+        poller.wait(should_stop=lambda: APP_CLOSING)
 
         if APP_CLOSING:
+            logger.info(f'SC2 client API stats: {poller.stats()}')
             break
 
+        # Log request stats every 10 minutes
+        if time.time() - last_stats_logged > 600:
+            logger.info(f'SC2 client API stats: {poller.stats()}')
+            last_stats_logged = time.time()
+
         # Skip if winrate data not showing OR no new replay analysed, meaning it's the same game (excluding the first game)
         if len(player_winrate_data) == 0 or len(AllReplays) == last_replay_amount:
             continue
@@ -570,7 +691,9 @@ def check_for_new_game():
 
         try:
             # Request player data from the game
-            resp = requests.get('http://localhost:6119/game', timeout=6).json()
+            resp = poller.poll()
+            if resp == None:
+                continue
             players = resp.get('players',list())
 
 
@@ -634,15 +757,6 @@ def check_for_new_game():
                     logger.info(f'Sending player data event: {data}')
                     sendEvent({'playerEvent': True,'data':data})
 
-        except requests.exceptions.ConnectionError:
-            logger.debug(f'SC2 request failed. Game not running.')
-
-        except json.decoder.JSONDecodeError:
-            logger.info('SC2 request json decoding failed (SC2 is starting or closing)')
-
-        except requests.exceptions.ReadTimeout:
-            logger.info('SC2 request timeout')
-
         except:
             logger.info(traceback.format_exc())
 
@@ -4,32 +4,112 @@ This module is used for generating overall stats from a list of replays (and pla
 """
 import os
 import time
-import pickle
+import itertools
 import traceback
 import statistics
 import s2protocol
 import threading
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 
 from SCOFunctions.MFilePath import truePath
 from SCOFunctions.MLogging import logclass
-from SCOFunctions.S2Parser import s2_parse_replay
-from SCOFunctions.ReplayAnalysis import analyse_replay
+from SCOFunctions.MReplayCache import ReplayCache, has_details, merge_details, split_details
+from SCOFunctions.MNegativeCache import negative_cache, REJECTED, PARSE, ANALYSE
+from SCOFunctions.MParseCache import parse_cache
+from SCOFunctions.MWinrateIndex import WinrateIndex
+from SCOFunctions.S2Parser import s2_parse_replay, probe_replay, prewarm_protocols, protocol_registry
+from SCOFunctions.ReplayAnalysis import analyse_replay, ANALYSIS_VERSION
 from SCOFunctions.MainFunctions import find_names_and_handles, find_replays, names_fallback
 from SCOFunctions.SC2Dictionaries import bonus_objectives, mc_units
 
 logger = logclass('MASS','INFO')
 lock = threading.Lock()
+parse_batch_size = 100 # Number of parsed replays added to the data at once
 
 
 def parse_replay(file):
-    """ Parse replay with added exceptions and set key-arguments """
+    """ Parse replay with added exceptions and set key-arguments.
+    Returns `(parsed_data, failure)` where failure is `(kind, reason)` if the replay was rejected or failed to parse.
+    Replays are probed first to reject them early. """
     try:
-        return s2_parse_replay(file, try_lastest=True, parse_events=False, onlyBlizzard=True, withoutRecoverEnabled=True)
+        reason = probe_replay(file, try_lastest=True)
+        if reason != None:
+            return None, (REJECTED, reason)
+
+        replay = s2_parse_replay(file, try_lastest=True, parse_events=False, onlyBlizzard=True, withoutRecoverEnabled=True)
+        return replay, None if replay != None else (REJECTED, 'rejected by parser')
     except s2protocol.decoders.TruncatedError:
-        return None
-    except:
+        return None, (PARSE, 'truncated')
+    except Exception as e:
         logger.error(traceback.format_exc())
-        return None
+        return None, (PARSE, type(e).__name__)
+
+
+def get_worker_count(workers=None):
+    """ Returns the number of worker processes to use. `None` or zero means all cores. """
+    if workers in {None, 0}:
+        return os.cpu_count() or 1
+    return max(1, int(workers))
+
+
+def worker_initializer(initializer, initargs):
+    """ Prepares a worker process. Parse cache entries are returned to the main process instead of being written. """
+    parse_cache.defer_writes()
+    if initializer != None:
+        initializer(*initargs)
+
+
+def worker_call(function, item):
+    """ Runs the function in a worker process. Returns its result, new parse cache entries and decoding times. """
+    return function(item), parse_cache.take_deferred(), protocol_registry.take_decode_time()
+
+
+def parallel_map(function, items, workers=None, stop=None, max_pending=None, initializer=None, initargs=(), cache_batch=20):
+    """ Runs `function` over `items` in a process pool and yields `(item, result)` as they finish.
+    `stop` is a callable checked after each result. When it returns True, pending work is cancelled.
+    At most `max_pending` items are queued in the pool at once (4 per worker by default).
+    `initializer(*initargs)` is called in each worker process when it starts.
+    Parse cache entries from workers are written here in batches of `cache_batch` entries,
+    and their decoding times are added to the protocol registry. """
+    workers = get_worker_count(workers)
+    max_pending = max_pending if max_pending != None else 4*workers
+    items = iter(items)
+    pending = dict()
+    cache_entries = list()
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=worker_initializer, initargs=(initializer, initargs)) as executor:
+        try:
+            for item in itertools.islice(items, max_pending):
+                pending[executor.submit(worker_call, function, item)] = item
+
+            while len(pending) > 0:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    item = pending.pop(future)
+                    try:
+                        result, entries, decode_time = future.result()
+                        cache_entries.extend(entries)
+                        protocol_registry.merge_decode_time(decode_time)
+                    except:
+                        logger.error(f'Worker failed on {item}\n{traceback.format_exc()}')
+                        result = None
+
+                    if len(cache_entries) >= cache_batch:
+                        parse_cache.store(cache_entries)
+                        cache_entries = list()
+
+                    yield item, result
+
+                    if stop != None and stop():
+                        return
+
+                # Refill the queue
+                for item in itertools.islice(items, len(done)):
+                    pending[executor.submit(worker_call, function, item)] = item
+        finally:
+            for future in pending:
+                future.cancel()
+            parse_cache.store(cache_entries)
 
 
 def calculate_difficulty_data(ReplayData):
@@ -482,7 +562,7 @@ def calculate_words(ReplayData):
 class mass_replay_analysis:
     """ Class for mass replay analysis"""
 
-    def __init__(self, ACCOUNTDIR):
+    def __init__(self, ACCOUNTDIR, workers=None):
 
         names, handles = find_names_and_handles(ACCOUNTDIR)
 
@@ -491,12 +571,18 @@ class mass_replay_analysis:
         self.parsed_replays = set()
         self.ReplayData = list()
         self.ReplayDataAll = list()
-        self.cachefile = truePath('cache_overall_stats')
+        self.replays_by_file = dict() # Replays from `ReplayDataAll` {file: replay}
+        self.cache = ReplayCache(truePath('cache_overall_stats.db'))
+        self.changed_replays = dict() # Replays changed since the last save {file: replay}
+        self.builds = set() # Protocol builds of cached replays
         self.winrate_data = dict()
+        self.winrate_index = WinrateIndex() # Player winrates updated with current replays
         self.current_replays = find_replays(ACCOUNTDIR)
         self.closing = False
         self.full_analysis_label = None
         self.full_analysis_finished = False
+        self.workers = workers
+        self.progress_callback = None
 
 
     def search(self, *args):
@@ -506,7 +592,8 @@ class mass_replay_analysis:
         races = ('terran','protoss','zerg')
 
         for r in self.ReplayData:
-            struct = str(r).lower()
+            # Search summaries, so replays with details loaded aren't searched differently
+            struct = str(split_details(r)[0]).lower()
             args_found = 0
             for arg in args:
                 # Special filter for races. Check enemy race directly.
@@ -527,42 +614,79 @@ class mass_replay_analysis:
     def load_cache(self):
         """ Try to load previously parsed replays """
         try:
-            if os.path.isfile(self.cachefile):
-                with open(self.cachefile,'rb') as f:
-                    self.ReplayDataAll = pickle.load(f)
-
-                self.parsed_replays = {r['file'] for r in self.ReplayDataAll}
+            self.cache.import_pickle(truePath('cache_overall_stats'))
+            self.cache.compact()
+            self.ReplayDataAll = self.cache.load()
+            self.replays_by_file = {r['file']:r for r in self.ReplayDataAll}
+            self.parsed_replays = set(self.replays_by_file)
+            self.builds = {r['build']['protocol_build'] for r in self.ReplayDataAll if 'build' in r}
+            prewarm_protocols(self.builds)
+
+            # Saved player winrates are updated to current replays
+            with lock:
+                self.winrate_index.set_state(self.cache.get_meta('winrate_index'))
+                self.update_data()
         except:
             logger.error(traceback.format_exc())
 
 
     def add_replays(self,replays):
-        """ Parses and adds new replays. Doesn't parse already parsed replays. """
-        replays_to_parse = {r for r in replays if not r in self.parsed_replays}
+        """ Parses and adds new replays. Doesn't parse already parsed replays.
+        Replays are parsed in parallel and added in batches as they finish. """
+        replays_to_parse = {r for r in replays if not r in self.parsed_replays and not negative_cache.is_failed(r, kinds=(REJECTED, PARSE), version=ANALYSIS_VERSION)}
         ts = time.time()
-        out = list()
+        parsed = 0
 
-        for r in replays_to_parse:
-            out.append(parse_replay(r))
-            if self.closing:
-                break
+        for batch in self.parse_replays(replays_to_parse):
+            files = {file for file, _, _ in batch}
+            for file, _, failure in batch:
+                if failure != None:
+                    negative_cache.add(file, failure[1], kind=failure[0], version=ANALYSIS_VERSION)
 
-        out += self.ReplayDataAll
-        out = [r for r in out if r != None]
+            with lock:
+                self.ReplayDataAll.extend(r for _, r, _ in batch if r != None)
+                self.replays_by_file.update((r['file'], r) for _, r, _ in batch if r != None)
+                self.changed_replays.update((r['file'], r) for _, r, _ in batch if r != None)
+                self.parsed_replays.update(files)
+                self.current_replays.update(files)
+                self.update_data()
 
-        with lock:
-            self.ReplayDataAll = out
-            self.parsed_replays = self.parsed_replays.union(replays_to_parse)
-            self.current_replays = self.current_replays.union(replays_to_parse)
-            self.update_data()
+            parsed += len(batch)
+            if self.progress_callback != None:
+                self.progress_callback((parsed, len(replays_to_parse)))
 
-        logger.info(f'Parsing {len(replays_to_parse)} replays in {time.time()-ts:.1f} seconds leaving us with {len(self.ReplayData)} games')
+        logger.info(f'Parsing {parsed} replays in {time.time()-ts:.1f} seconds leaving us with {len(self.ReplayData)} games')
+        if parsed > 0:
+            logger.info(f'Protocol decoding stats: {protocol_registry.stats()}')
 
         if len(self.main_names) == 0 and len(self.main_handles) > 0:
             self.main_names = names_fallback(self.main_handles, self.ReplayDataAll)
             logger.info(f'No names from links. Falling back. New names:  {self.main_names}')
 
 
+    def parse_replays(self, replays):
+        """ Generator parsing replays and yielding batches of `(file, parsed_data, failure)`.
+        Uses a process pool unless there is only a few replays or a single worker. """
+        batch = list()
+
+        if get_worker_count(self.workers) == 1 or len(replays) < parse_batch_size:
+            results = ((file, parse_replay(file)) for file in replays)
+        else:
+            results = parallel_map(parse_replay, replays, workers=self.workers, stop=lambda: self.closing, initializer=prewarm_protocols, initargs=(self.builds,))
+
+        for file, result in results:
+            replay, failure = result if result != None else (None, None)
+            batch.append((file, replay, failure))
+            if len(batch) >= parse_batch_size:
+                yield batch
+                batch = list()
+            if self.closing:
+                break
+
+        if len(batch) > 0:
+            yield batch
+
+
     def add_parsed_replay(self, full_data):
         """ Adds already parsed replay. Format has to be from my S2Parser"""
         parsed_data = full_data.get('parser')
@@ -577,7 +701,17 @@ class mass_replay_analysis:
             parsed_data = self.format_data(full_data)
 
             with lock:
+                # Replays already in mass analysis aren't added again, they are only updated if not fully analysed
+                replay = self.replays_by_file.get(parsed_data['file'])
+                if replay != None:
+                    if not 'comp' in replay:
+                        replay.update(parsed_data)
+                        self.changed_replays[replay['file']] = replay
+                    return
+
                 self.ReplayDataAll.append(parsed_data)
+                self.replays_by_file[parsed_data['file']] = parsed_data
+                self.changed_replays[parsed_data['file']] = parsed_data
                 self.parsed_replays.add(parsed_data['file'])
                 self.current_replays.add(parsed_data['file'])
                 self.update_data()
@@ -585,8 +719,10 @@ class mass_replay_analysis:
 
     @staticmethod
     def format_data(full_data):
-        """ Formats data returned by replay analysis into a single datastructure used here"""
-        parsed_data = full_data['parser']
+        """ Formats data returned by replay analysis into a single datastructure used here.
+        The parser output is copied, as the replay analysis might be shown on the overlay at the same time. """
+        parsed_data = full_data['parser'].copy()
+        parsed_data['players'] = [p.copy() for p in parsed_data['players']]
         parsed_data['accurate_length'] = full_data['length']*1.4
         parsed_data['bonus'] = full_data['bonus']
         parsed_data['comp'] = full_data['comp']
@@ -602,10 +738,43 @@ class mass_replay_analysis:
 
 
     def save_cache(self):
-        """ Saves cache """
+        """ Saves replays that changed since the last save """
+        negative_cache.save()
+
         with lock:
-            with open(self.cachefile,'wb') as f:
-                pickle.dump(self.ReplayDataAll, f, protocol=pickle.HIGHEST_PROTOCOL)
+            try:
+                self.cache.save(self.changed_replays.values())
+                if self.winrate_index.changed:
+                    self.cache.set_meta('winrate_index', self.winrate_index.get_state())
+            except:
+                logger.error(f'Failed to save cache\n{traceback.format_exc()}')
+                return
+
+            # Details are in the cache now, they will be loaded when needed. Replays are replaced
+            # with summaries instead of being changed, as they might be used in other threads.
+            if len(self.changed_replays) > 0:
+                summaries = {file:split_details(replay)[0] for file, replay in self.changed_replays.items()}
+                self.ReplayDataAll = [summaries.get(r['file'], r) for r in self.ReplayDataAll]
+                self.replays_by_file.update(summaries)
+                self.update_data()
+            self.changed_replays = dict()
+
+
+    def get_details(self, file):
+        """ Returns the replay with its details (chat messages, units, icons) loaded from the cache """
+        replay = self.replays_by_file.get(file)
+        if replay == None or has_details(replay):
+            return replay
+        return merge_details(replay, self.cache.load_details([file]).get(file))
+
+
+    def with_details(self, replays, chunk=500):
+        """ Generator yielding replays with their details loaded from the cache. Details are not kept in memory. """
+        for i in range(0, len(replays), chunk):
+            replays_chunk = replays[i:i+chunk]
+            details = self.cache.load_details(r['file'] for r in replays_chunk if not has_details(r))
+            for replay in replays_chunk:
+                yield merge_details(replay, details.get(replay['file']))
 
 
     def update_accountdir(self, ACCOUNTDIR):
@@ -617,15 +786,25 @@ class mass_replay_analysis:
         self.main_names = names
         self.main_handles = handles
         self.add_replays(replays)
-        self.current_replays = replays
-        self.update_data()
+        with lock:
+            self.current_replays = replays
+            self.update_data()
         self.save_cache()
 
 
     def update_data(self):
-        """ Updates current data """
+        """ Updates current data and player winrates. Replays that are no longer current are removed from winrates. """
         self.ReplayData = [r for r in self.ReplayDataAll if r['file'] in self.current_replays]
 
+        # Rebuild if some replays are no longer current (or saved winrates include replays that aren't cached)
+        if not self.winrate_index.files <= self.current_replays & self.replays_by_file.keys():
+            self.winrate_index.rebuild(self.ReplayData)
+            return
+
+        for replay in self.ReplayData:
+            if not replay['file'] in self.winrate_index.files:
+                self.winrate_index.add(replay)
+
 
     def initialize(self):
         """ Executes full initialization """
@@ -641,68 +820,82 @@ class mass_replay_analysis:
 
 
     def run_full_analysis(self):
-        """ Run full analysis on all replays """
+        """ Run full analysis on all replays. Replays are analysed in a process pool
+        and merged into the data as they finish. """
         self.closing = False
 
         # Get current status & updated
+        with lock:
+            replays = list(self.ReplayDataAll)
+        total = len(replays)
+        def needs_analysis(r):
+            """ Replays not analysed yet, or that failed to be analysed with an older analysis version """
+            if 'comp' in r:
+                return False
+            if not 'full_analysis' in r:
+                return True
+            return r['full_analysis'] == False and not negative_cache.is_failed(r['file'], kinds=(ANALYSE,), version=ANALYSIS_VERSION)
+
         fully_parsed = 0
-        for r in self.ReplayDataAll:
-            if 'full_analysis' in r or 'comp' in r:
+        for r in replays:
+            if not needs_analysis(r):
                 fully_parsed += 1
-        self.full_analysis_label.setText(f'Running... {fully_parsed}/{len(self.ReplayDataAll)} ({100*fully_parsed/len(self.ReplayDataAll):.0f}%)')
+        self.full_analysis_label.setText(f'Running... {fully_parsed}/{total} ({100*fully_parsed/total:.0f}%)')
         fully_parsed_at_start = fully_parsed
-        
+
+        # Replays that are not fully parsed yet
+        to_analyse = {r['file']: r for r in replays if needs_analysis(r) and os.path.isfile(r['file'])}
+
         # Start 
-        logger.info('Starting full analysis!')
+        logger.info(f'Starting full analysis! ({len(to_analyse)} replays, {get_worker_count(self.workers)} workers)')
         start = time.time()
         idx = 0
         eta = '?'
-        for r in self.ReplayDataAll:
+        for file, full_data in parallel_map(analyse_replay, to_analyse, workers=self.workers, stop=lambda: self.closing, initializer=prewarm_protocols, initargs=(self.builds,)):
+            # Saving the cache replaces replays with their summaries
+            with lock:
+                r = self.replays_by_file.get(file, to_analyse[file])
+            if full_data == None or len(full_data) == 0:
+                negative_cache.add(file, 'no output', kind=ANALYSE, version=ANALYSIS_VERSION)
+                with lock:
+                    r['full_analysis'] = False
+                    self.changed_replays[file] = r
+                continue
+
+            # Update data
+            idx += 1
+            fully_parsed += 1
+
+            # Calculate eta
+            if (fully_parsed - fully_parsed_at_start) > 15 and (fully_parsed - fully_parsed_at_start) % 3 == 0:
+                eta = (total - fully_parsed) / ((fully_parsed - fully_parsed_at_start) / (time.time() - start))
+                eta = time.strftime("%H:%M:%S", time.gmtime(eta))
+
+            # Update widget
+            with lock:
+                try:
+                    formated = self.format_data(full_data)
+                    r.update(formated)
+                    self.changed_replays[file] = r
+                except:
+                    logger.error(traceback.format_exc())
+                self.full_analysis_label.setText(f'Estimated remaining time: {eta}\nRunning... {fully_parsed}/{total} ({100*fully_parsed/total:.0f}%)')
+
             # Save cache every now and then
             if idx >= 20:
                 idx = 0
                 self.save_cache()
 
-            # Interrupt the analysis if the app is closing
-            if self.closing:
-                self.save_cache()
-                return False
-
-            # Analyze those that are not fully parsed yet
-            if not 'full_analysis' in r and not 'comp' in r:
-                if not os.path.isfile(r['file']):
-                    continue
-
-                full_data = analyse_replay(r['file'])
-
-                full_data['full_analysis'] = True
-                if len(full_data) < 2:
-                    with lock:
-                        r['full_analysis'] = False
-                    continue
-
-                # Update data
-                idx += 1
-                fully_parsed +=1
-
-                # Calculate eta
-                if (fully_parsed - fully_parsed_at_start) > 15 and (fully_parsed - fully_parsed_at_start) % 3 == 0:
-                    eta = (len(self.ReplayDataAll) - fully_parsed) / ((fully_parsed - fully_parsed_at_start) / (time.time() - start))
-                    eta = time.strftime("%H:%M:%S", time.gmtime(eta))
-                    
-                # Update widget
-                with lock:
-                    try:
-                        formated = self.format_data(full_data)
-                        r.update(formated)
-                    except:
-                        logger.error(traceback.format_exc())
-                    self.full_analysis_label.setText(f'Estimated remaining time: {eta}\nRunning... {fully_parsed}/{len(self.ReplayDataAll)} ({100*fully_parsed/len(self.ReplayDataAll):.0f}%)')
+        # Interrupt the analysis if the app is closing
+        if self.closing:
+            self.save_cache()
+            return False
 
         if idx > 0:
             self.save_cache()
-        self.full_analysis_label.setText(f'Full analysis completed! {fully_parsed}/{len(self.ReplayDataAll)} | {100*fully_parsed/len(self.ReplayDataAll):.0f}%')
-        logger.info(f'Full analysis completed in {time.time()-start:.0f} seconds!')        
+        self.full_analysis_label.setText(f'Full analysis completed! {fully_parsed}/{total} | {100*fully_parsed/total:.0f}%')
+        logger.info(f'Full analysis completed in {time.time()-start:.0f} seconds!')
+        logger.info(f'Protocol decoding stats: {protocol_registry.stats()}')        
         self.full_analysis_finished = True
         return True
 
@@ -726,42 +919,11 @@ class mass_replay_analysis:
 
 
     def calculate_player_winrate_data(self):
-        """ Calculates player winrate data """
-        winrate_data = dict()
-        for replay in self.ReplayData:
-            for p in {1,2}:
-                player = replay['players'][p]['name']
-                if not player in winrate_data:
-                    winrate_data[player] = [0,0,list(),list(),0] # Wins, losses, apm, commander, commander frequency
-
-                if replay['result'] == 'Victory':
-                    winrate_data[player][0] += 1
-                else:
-                    winrate_data[player][1] += 1
-
-                winrate_data[player][2].append(replay['players'][p]['apm'])
-                winrate_data[player][3].append(replay['players'][p]['commander'])
-
-
-        for player in winrate_data:
-            # Median APM
-            if len(winrate_data[player][2]) > 0:
-                winrate_data[player][2] = statistics.median(winrate_data[player][2])
-            else:
-                winrate_data[player][2] = 0
-
-            # Commander mode and frequency
-            if len(winrate_data[player][3]) > 0:
-                mode = statistics.mode(winrate_data[player][3])
-                winrate_data[player][4] = winrate_data[player][3].count(mode)/len(winrate_data[player][3])
-                winrate_data[player][3] = mode
-            else:
-                winrate_data[player][3] = ''
-                
-        # Sort by wins
-        winrate_data = {k:v for k,v in sorted(winrate_data.items(), key=lambda x:x[1][0], reverse=True)}
-        self.winrate_data = winrate_data
-        return winrate_data
+        """ Returns player winrate data {player: [wins, losses, median apm, most played commander, its frequency]}.
+        Median APM and the most played commander are recalculated only for players whose replays changed
+        since the last call. Rows of all players are still sorted and copied. """
+        self.winrate_data = self.winrate_index.winrate_data()
+        return self.winrate_data
 
 
     def find_banks(self, allreplays=False):
@@ -860,14 +1022,17 @@ class mass_replay_analysis:
         MapData = calculate_map_data(data)
         CommanderData, AllyCommanderData = calculate_commander_data(data, self.main_handles)
         RegionData = calculate_region_data(data, self.main_handles)
-        UnitData = None if not self.full_analysis_finished else calculate_unit_stats(data, self.main_handles)
+        UnitData = None if not self.full_analysis_finished else calculate_unit_stats(self.with_details(data), self.main_handles)
 
         return {'UnitData':UnitData, 'RegionData':RegionData, 'DifficultyData':DifficultyData,'MapData':MapData,'CommanderData':CommanderData,'AllyCommanderData':AllyCommanderData, 'games': len(data)}
 
 
-def mass_replay_analysis_thread(ACCOUNTDIR):
-    """ Main thread for mass replay analysis. Handles all initialization. """
+def mass_replay_analysis_thread(ACCOUNTDIR, workers=None, progress_callback=None):
+    """ Main thread for mass replay analysis. Handles all initialization.
+    `workers` is the number of processes used for parsing (`None` or 0 for all cores)
+    `progress_callback` is called with (parsed, total) after each parsed batch """
 
-    CAnalysis = mass_replay_analysis(ACCOUNTDIR)
+    CAnalysis = mass_replay_analysis(ACCOUNTDIR, workers=workers)
+    CAnalysis.progress_callback = progress_callback
     CAnalysis.initialize()
     return CAnalysis
\ No newline at end of file
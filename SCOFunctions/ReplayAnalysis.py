@@ -3,11 +3,13 @@ import mpyq
 import json
 import time
 import traceback
+from array import array
 from pprint import pprint
+from collections import namedtuple
 
 from SCOFunctions.MLogging import logclass
 from SCOFunctions.S2Parser import s2_parse_replay
-from SCOFunctions.SC2Dictionaries import UnitNameDict, CommanderMastery, UnitAddKillsTo, UnitCompDict, UnitsInWaves, COMasteryUpgrades, HFTS_Units, TUS_Units, prestige_upgrades, amon_player_ids
+from SCOFunctions.SC2Dictionaries import UnitNameDict, CommanderMastery, UnitAddKillsTo, UnitCompDict, UnitsInWaves, HFTS_Units, TUS_Units, amon_player_ids, mastery_upgrade_index, prestige_upgrade_names
 
 
 duplicating_units = ['HotSRaptor','MutatorAmonArtanis','HellbatBlackOps','LurkerStetmannBurrowed']
@@ -25,8 +27,62 @@ primal_combat_predecessors = {'DehakaRavasaur':'DehakaZerglingLevel2','DehakaRoa
 dont_include_units = {"SuperWarpGate","VoidRiftUnselectable","UnbuildableRocksUnit","TrooperMengskWeaponAAPickup","TrooperMengskWeaponFlamethrowerPickup","TrooperMengskWeaponImprovedPickup","PsiDisintegratorPowerLink","ProtossDockingBayUnit","PnPHybridVoidRift","PlatformConnector","MutatorAmonKaraxInvisiblePylon","KorhalGateControl","HybridStasisChamberA","HybridHoldingCellSmallUnit","HybridHoldingCellUnit","GateControlUnit","Food1000","COOPTerrazineTank","ExpeditionJumpGate","EnemyPathingBlocker4x4","InvisibleEscortFlying","DestructibleUmojanLabTestTube",'AmonHostDeathBeamUnit','DamagedMutatorLaserDrill'}
 salvage_units = {"PerditionTurretUnderground","PerditionTurret","ArtilleryMengsk","Bunker","FlamingBetty","KelMorianGrenadeTurret","KelMorianMissileTurret","NovaACLaserTurret","TychusSCVAutoTurret","BunkerDepotMengsk"}
 UnitAddLossesTo = {'TorrasqueChrysalis':'Ultralisk','SiegeTankWreckage':'Siege Tank','ThorWreckageSwann':'Thor', 'ThorWreckage':'Thor'}
+analysed_events = {'NNet.Replay.Tracker.SUpgradeEvent','NNet.Replay.Tracker.SUnitBornEvent','NNet.Replay.Tracker.SUnitInitEvent','NNet.Replay.Tracker.SUnitTypeChangeEvent','NNet.Replay.Tracker.SUnitOwnerChangeEvent','NNet.Replay.Tracker.SUnitDiedEvent'}
 
 logger = logclass('REPA','INFO')
+ANALYSIS_VERSION = 1 # Increase when changes in parsing or analysis can fix replays that failed before
+
+
+"""
+Bonus objectives completed by killing a unit.
+Sometimes checking killing player to prevent despawns from counting.
+In case of trains, killing player is almost always None, and so position of the train is checked.
+
+`maps` - the rule applies if any of these is in the map name
+`unit_types` - killed unit types
+`losing_player` - player owning the killed unit
+`killing_players` - players that have to kill the unit, `None` for any
+`check` - additional condition check(event, game_time, amon_units, bonus_timings), `None` for no condition
+`offset` - time offset added to the bonus timing
+"""
+BonusRule = namedtuple('BonusRule', ['maps', 'unit_types', 'losing_player', 'killing_players', 'check', 'offset'])
+
+bonus_rules = (
+    BonusRule(('Void Thrashing',), {'ArchAngelCoopFighter','ArchAngelCoopAssault'}, 5, None, None, 0),
+    BonusRule(('Dead of Night',), {'ACVirophage'}, 7, {1,2}, None, 0),
+    BonusRule(('Lock & Load','[MM] LnL'), {'XelNagaConstruct'}, 3, None, None, 0),
+    BonusRule(('Chain of Ascension',), {'SlaynElemental'}, 10, {1,2}, None, 0),
+    BonusRule(('Rifts to Korhal',), {'ACPirateCapitalShip'}, 8, {1,2}, None, 0),
+    BonusRule(('Cradle of Death',), {'LogisticsHeadquarters'}, 3, None, None, -8), # The explosion is delayed
+    BonusRule(('Part and Parcel',), {'Caboose','TarsonisEngine'}, 8, None,
+              lambda event, game_time, amon_units, bonus_timings: not round(game_time,0) in bonus_timings and not (event['m_x'] == 169 and event['m_y'] == 99) and not (event['m_x'] == 38 and event['m_y'] == 178), 0),
+    BonusRule(('Oblivion Express',), {'TarsonisEngineFast'}, 7, None, lambda event, game_time, amon_units, bonus_timings: event['m_x'] < 196, 0),
+    BonusRule(('Mist Opportunities',), {'COOPTerrazineTank'}, 3, {1,2}, None, 0),
+    BonusRule(('The Vermillion Problem',), {'RedstoneSalamander','RedstoneSalamanderBurrowed'}, 9, {1,2}, None, 0),
+    BonusRule(('Miner Evacuation',), {'Blightbringer'}, 5, {1,2}, None, 0),
+    BonusRule(('Miner Evacuation',), {'NovaEradicator'}, 9, {1,2}, lambda event, game_time, amon_units, bonus_timings: amon_units['NovaEradicator'][1] == 1, 0),
+    BonusRule(('Temple of the Past',), {'ZenithStone'}, 8, None, None, 0),
+    )
+
+
+def compile_bonus_rules(map_name, rules=bonus_rules):
+    """ Returns bonus objective rules for the map as a dictionary {killed unit type: [rules]} """
+    compiled = dict()
+    for rule in rules:
+        if any(m in map_name for m in rule.maps):
+            for unit_type in rule.unit_types:
+                compiled.setdefault(unit_type, list()).append(rule)
+    return compiled
+
+
+def match_bonus_rule(compiled_rules, killed_unit_type, losing_player, killing_player, event, game_time, amon_units, bonus_timings):
+    """ Returns the first rule completed by the unit death or `None` """
+    for rule in compiled_rules.get(killed_unit_type, ()):
+        if rule.losing_player == losing_player and \
+           (rule.check == None or rule.check(event, game_time, amon_units, bonus_timings)) and \
+           (rule.killing_players == None or killing_player in rule.killing_players):
+            return rule
+    return None
 
 
 def contains_skip_strings(pname):
@@ -40,19 +96,12 @@ def contains_skip_strings(pname):
 
 def upgrade_is_in_mastery_upgrades(upgrade):
     """ Checks if the upgrade is in mastery upgrades, if yes, returns the Commnader and upgrade index"""
-    for co in COMasteryUpgrades:
-        if upgrade in COMasteryUpgrades[co]:
-            return co, COMasteryUpgrades[co].index(upgrade)
-    return False, 0
+    return mastery_upgrade_index.get(upgrade, (False, 0))
 
 
 def prestige_talent_name(upgrade):
     """ Checks if the upgrade is in prestige upgrades. If yes, returns Prestige name"""
-
-    for co in prestige_upgrades:
-        if upgrade in prestige_upgrades[co]:
-            return prestige_upgrades[co][upgrade]
-    return None
+    return prestige_upgrade_names.get(upgrade, None)
 
 
 def switch_names(pdict):
@@ -93,46 +142,58 @@ def switch_names(pdict):
     return temp_dict
 
 
-def get_enemy_comp(identified_waves):
-    """ Takes indentified waves and tries to match them with known enemy AI comps.
-        Waves are identified as events where 6+ units were created at the same second. """
+class EnemyCompClassifier:
+    """ Matches identified waves with known enemy AI comps.
+    Waves of each AI are indexed once, so each identified wave is classified with two dictionary lookups. """
 
-    # Each AI gets points for each matching wave
-    results = dict()
-    for AI in UnitCompDict:
-        results[AI] = 0
+    def __init__(self, comps):
+        self.comps = tuple(comps)
+        self.exact = dict() # {wave: [(AI, points), ...]}
+        self.close = dict() # {wave without one unit: [(AI, points), ...]}
 
-    # Lets go through our waves, compare them to known AI unit waves
-    for iden_wave in identified_waves:
-        types = set(identified_waves[iden_wave])
-        if len(types) == 0:
-            continue
-
-        logger.debug(f'{"-"*40}\nChecking this wave type: {types}\n')
-        for AI in UnitCompDict:
-            for idx,wave in enumerate(UnitCompDict[AI]):
+        for AI in comps:
+            for wave in comps[AI]:
                 # Don't include Medivac, it's removed from wave units as well
-                wave.difference_update({'Medivac'})
-
-                # Identical wave
-                if types == wave:
-                    logger.debug(f'"{AI}" wave {idx+1} is the same: {wave}')
-                    results[AI] += 1*len(wave)
-                    continue
+                wave = frozenset(wave) - {'Medivac'}
+                self.exact.setdefault(wave, list()).append((AI, 1*len(wave)))
 
                 # In case of alternate units or some noise
-                if types.issubset(wave) and len(wave) - len(types) == 1:
-                    logger.debug(f'"{AI}" wave {idx+1} is a close subset: {types} | {wave}')
-                    results[AI] += 0.25*len(wave)
+                for unit in wave:
+                    self.close.setdefault(wave - {unit}, list()).append((AI, 0.25*len(wave)))
 
-    results = {k:v for k,v in sorted(results.items(), key=lambda x:x[1],reverse=True) if v!=0}
-    logger.debug(f'{"-"*40}\nAnd results are: {results}')
 
-    # Return the comp with the most points
-    if len(results) > 0:
-        logger.debug(f'Most likely AI: "{list(results.keys())[0]}" with {100*list(results.values())[0]/sum(results.values()):.1f}% points\n\n')
-        return list(results.keys())[0]
-    return 'Unidentified AI'
+    def classify(self, identified_waves):
+        """ Returns the most likely AI for identified waves {time: [unit types]} """
+        # Each AI gets points for each matching wave
+        results = {AI:0 for AI in self.comps}
+
+        for iden_wave in identified_waves:
+            types = frozenset(identified_waves[iden_wave])
+            if len(types) == 0:
+                continue
+
+            for AI, points in self.exact.get(types, ()):
+                results[AI] += points
+            for AI, points in self.close.get(types, ()):
+                results[AI] += points
+
+        results = {k:v for k,v in sorted(results.items(), key=lambda x:x[1],reverse=True) if v!=0}
+        logger.debug(f'{"-"*40}\nAnd results are: {results}')
+
+        # Return the comp with the most points
+        if len(results) > 0:
+            logger.debug(f'Most likely AI: "{list(results.keys())[0]}" with {100*list(results.values())[0]/sum(results.values()):.1f}% points\n\n')
+            return list(results.keys())[0]
+        return 'Unidentified AI'
+
+
+enemy_comp_classifier = EnemyCompClassifier(UnitCompDict)
+
+
+def get_enemy_comp(identified_waves):
+    """ Takes indentified waves and tries to match them with known enemy AI comps.
+        Waves are identified as events where 6+ units were created at the same second. """
+    return enemy_comp_classifier.classify(identified_waves)
 
 
 def unitid(event, killer=False):
@@ -154,8 +215,101 @@ def unitid(event, killer=False):
     return recycleindex*100000 + index
 
 
-def analyse_replay(filepath, main_player_handles=None):
-    """ Analyses the replay and returns the analysis"""
+class UnitTable:
+    """ Tracks unit type and owner for each unit id.
+    Unit type names are interned to small integers, types and owners are stored in arrays indexed by row. """
+
+    def __init__(self):
+        self.rows = dict() # {unit_id: row}
+        self.types = array('H')
+        self.owners = array('h')
+        self.type_names = list() # [name]
+        self.type_ids = dict() # {name: type id}
+        self.decoded = dict() # {raw name: name}
+
+    def name(self, raw):
+        """ Returns decoded unit type name. Each raw name is decoded only once. """
+        name = self.decoded.get(raw)
+        if name == None:
+            name = self.decoded[raw] = raw.decode()
+        return name
+
+    def type_id(self, name):
+        """ Returns an interned id for the unit type name """
+        type_id = self.type_ids.get(name)
+        if type_id == None:
+            type_id = self.type_ids[name] = len(self.type_names)
+            self.type_names.append(name)
+        return type_id
+
+    def add(self, unit_id, unit_type, owner):
+        """ Adds a unit or replaces a unit with the same id """
+        row = self.rows.get(unit_id)
+        if row == None:
+            self.rows[unit_id] = len(self.types)
+            self.types.append(self.type_id(unit_type))
+            self.owners.append(owner)
+        else:
+            self.types[row] = self.type_id(unit_type)
+            self.owners[row] = owner
+
+    def __contains__(self, unit_id):
+        return unit_id in self.rows
+
+    def __len__(self):
+        return len(self.rows)
+
+    def type(self, unit_id):
+        """ Returns unit type. Raises KeyError for unknown units. """
+        return self.type_names[self.types[self.rows[unit_id]]]
+
+    def owner(self, unit_id):
+        """ Returns unit owner. Raises KeyError for unknown units. """
+        return self.owners[self.rows[unit_id]]
+
+    def set_type(self, unit_id, unit_type):
+        self.types[self.rows[unit_id]] = self.type_id(unit_type)
+
+    def set_owner(self, unit_id, owner):
+        self.owners[self.rows[unit_id]] = owner
+
+
+class UnitCounter:
+    """ Counts [#created, #died, #kills, #killfraction] for each unit type. Counts are stored in arrays indexed by row.
+    Unit types keep the order in which they were added. """
+
+    def __init__(self):
+        self.rows = dict() # {unit_type: row}
+        self.columns = (array('l'), array('l'), array('l'))
+
+    def __contains__(self, unit_type):
+        return unit_type in self.rows
+
+    def __getitem__(self, unit_type):
+        """ Returns a copy of counts for the unit type """
+        row = self.rows[unit_type]
+        return [self.columns[0][row], self.columns[1][row], self.columns[2][row], 0]
+
+    def add(self, unit_type, column, amount=1):
+        """ Adds to the count. Adds the unit type if it's not there. """
+        row = self.rows.get(unit_type)
+        if row == None:
+            row = self.rows[unit_type] = len(self.rows)
+            for c in self.columns:
+                c.append(0)
+        self.columns[column][row] += amount
+
+    def add_existing(self, unit_type, column, amount=1):
+        """ Adds to the count. Raises KeyError if the unit type isn't there. """
+        self.columns[column][self.rows[unit_type]] += amount
+
+    def to_dict(self):
+        """ Returns counts as a dictionary {unit_type: [#created, #died, #kills, #killfraction]} """
+        return {unit_type: [self.columns[0][row], self.columns[1][row], self.columns[2][row], 0] for unit_type, row in self.rows.items()}
+
+
+def analyse_replay(filepath, main_player_handles=None, use_cache=True):
+    """ Analyses the replay and returns the analysis. `use_cache` is passed to the parser. """
 
     """
     This whole function is a bit messy. It originated in a very different form.
@@ -166,16 +320,16 @@ def analyse_replay(filepath, main_player_handles=None):
     """
 
     # Data structure is {unitType : [#created, #died, #kills, #killfraction]}
-    unit_type_dict_main = {}
-    unit_type_dict_ally = {}
-    unit_type_dict_amon = {}
+    unit_counts_main = UnitCounter()
+    unit_counts_ally = UnitCounter()
+    unit_counts_amon = UnitCounter()
     logger.info(f'Analysing: {filepath}')
 
     # Load the replay
     replay = None
     for i in range(3):
         try:
-            replay = s2_parse_replay(filepath, return_events=True)
+            replay = s2_parse_replay(filepath, return_events=True, event_types=analysed_events, use_cache=use_cache)
             break
         except:  # You can get an error here if SC2 didn't finish writing into the file. Very rare.
             logger.error(f'Parsing error ({filepath})\n{traceback.format_exc()}')
@@ -239,7 +393,7 @@ def analyse_replay(filepath, main_player_handles=None):
     logger.debug(f'Report dict: {replay_report_dict}')
 
     # Events
-    unit_dict = {} # Data structure is {unit_id : [UnitType, Owner]}; used to track all units
+    unit_dict = UnitTable() # Unit type and owner for each unit_id; used to track all units
     DT_HT_Ignore = [0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0] # Ignore certain amount of DT/HT deaths after archon is initialized. DT_HT_Ignore[player]
     killcounts = [0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0]
     START_TIME = replay['start_time']
@@ -259,413 +413,398 @@ def analyse_replay(filepath, main_player_handles=None):
     AbathurKillLocusts = set()
     MutatorDehakaDragUnitIDs = set()
     MWBonusInitialTiming = [0,0]
+    map_bonus_rules = compile_bonus_rules(replay['map_name'])
 
     last_aoe_unit_killed = [0]*17
     for player in range(1,16):
         last_aoe_unit_killed[player] = [None, 0] if player in amon_players else None
 
-    for event in replay['events']:
-        # Skip events after the game ended
-        if event['_gameloop']/16 > END_TIME:
-            continue
-
-        if event['_event'] == 'NNet.Replay.Tracker.SUpgradeEvent' and event['m_playerId'] in [1,2]:
-            _upg_name = event['m_upgradeTypeName'].decode()
-            _upg_pid = event['m_playerId']
-
-            # Commander fallback (used for arcade maps)
-            if _upg_name in commander_upgrades:
-                commander_fallback[_upg_pid] = commander_upgrades[_upg_name]
-
-            # Mastery upgrade fallback (used for arcade maps)
-            mas_commander, mas_index = upgrade_is_in_mastery_upgrades(_upg_name)
-            if mas_commander:
-                logger.debug(f'Player {_upg_pid} (com: {mas_commander}) got upgrade {_upg_name} (idx: {mas_index}) (count: {event["m_count"]})')
-                mastery_fallback[_upg_pid][mas_index] = event['m_count']
-
-            # Prestige talents
-            _prestige = prestige_talent_name(_upg_name)
-            if _prestige != None:
-                PrestigeTalents[_upg_pid] = _prestige
-
-        if event['_event'] in ['NNet.Replay.Tracker.SUnitBornEvent','NNet.Replay.Tracker.SUnitInitEvent']:
-            _unit_type = event['m_unitTypeName'].decode()
-            _ability_name = event.get('m_creatorAbilityName', None)
-            _ability_name = _ability_name.decode() if _ability_name != None else None
-
-            _control_pid = event['m_controlPlayerId']
-            unit_dict[unitid(event)] = [_unit_type, _control_pid]
-
-            # Certain hero units don't die, instead lets track their revival beacons/cocoons. Let's assume they will finish reviving.
-            if _unit_type in revival_types and _control_pid in [1,2] and event['_gameloop']/16 > START_TIME+1:
-                if _control_pid == main_player:
-                    unit_type_dict_main[revival_types[_unit_type]][1] += 1
-                    unit_type_dict_main[revival_types[_unit_type]][0] += 1
-                if _control_pid == ally_player:
-                    unit_type_dict_ally[revival_types[_unit_type]][1] += 1
-                    unit_type_dict_ally[revival_types[_unit_type]][0] += 1
-
-            # Primal combat fix. For every morph we are substracting two losses from the base unit type
-            if _unit_type in primal_combat_predecessors:
-                logger.debug(f'{_unit_type} substracting from {primal_combat_predecessors[_unit_type]}\n')
-                if main_player == _control_pid:
-                    unit_type_dict_main[primal_combat_predecessors[_unit_type]][1] -= 2
-                if ally_player == _control_pid:
-                    unit_type_dict_ally[primal_combat_predecessors[_unit_type]][1] -= 2
+    """
+    Event handlers. Each handler gets the event, its unit id and its time in seconds.
+    """
 
-            # Save stats for units created
+    def upgrade(event, uid, seconds):
+        if not event['m_playerId'] in [1,2]:
+            return
+
+        _upg_name = event['m_upgradeTypeName'].decode()
+        _upg_pid = event['m_playerId']
+
+        # Commander fallback (used for arcade maps)
+        if _upg_name in commander_upgrades:
+            commander_fallback[_upg_pid] = commander_upgrades[_upg_name]
+
+        # Mastery upgrade fallback (used for arcade maps)
+        mas_commander, mas_index = upgrade_is_in_mastery_upgrades(_upg_name)
+        if mas_commander:
+            logger.debug(f'Player {_upg_pid} (com: {mas_commander}) got upgrade {_upg_name} (idx: {mas_index}) (count: {event["m_count"]})')
+            mastery_fallback[_upg_pid][mas_index] = event['m_count']
+
+        # Prestige talents
+        _prestige = prestige_talent_name(_upg_name)
+        if _prestige != None:
+            PrestigeTalents[_upg_pid] = _prestige
+
+
+    def unit_created(event, uid, seconds):
+        nonlocal LastBiomassPosition
+        _unit_type = unit_dict.name(event['m_unitTypeName'])
+        _ability_name = event.get('m_creatorAbilityName', None)
+        _ability_name = _ability_name.decode() if _ability_name != None else None
+
+        _control_pid = event['m_controlPlayerId']
+        unit_dict.add(uid, _unit_type, _control_pid)
+
+        # Certain hero units don't die, instead lets track their revival beacons/cocoons. Let's assume they will finish reviving.
+        if _unit_type in revival_types and _control_pid in [1,2] and seconds > START_TIME+1:
+            if _control_pid == main_player:
+                unit_counts_main.add_existing(revival_types[_unit_type], 1, 1)
+                unit_counts_main.add_existing(revival_types[_unit_type], 0, 1)
+            if _control_pid == ally_player:
+                unit_counts_ally.add_existing(revival_types[_unit_type], 1, 1)
+                unit_counts_ally.add_existing(revival_types[_unit_type], 0, 1)
+
+        # Primal combat fix. For every morph we are substracting two losses from the base unit type
+        if _unit_type in primal_combat_predecessors:
+            logger.debug(f'{_unit_type} substracting from {primal_combat_predecessors[_unit_type]}\n')
             if main_player == _control_pid:
-                if _unit_type in unit_type_dict_main:
-                    unit_type_dict_main[_unit_type][0] += 1
-                else:
-                    unit_type_dict_main[_unit_type] = [1,0,0,0]
-
+                unit_counts_main.add_existing(primal_combat_predecessors[_unit_type], 1, -2)
             if ally_player == _control_pid:
-                if _unit_type in unit_type_dict_ally:
-                    unit_type_dict_ally[_unit_type][0] += 1
-                else:
-                    unit_type_dict_ally[_unit_type] = [1,0,0,0]
+                unit_counts_ally.add_existing(primal_combat_predecessors[_unit_type], 1, -2)
 
-            if _control_pid in amon_players:
-                if _ability_name == 'MutatorAmonDehakaDrag':
-                    MutatorDehakaDragUnitIDs.add(unitid(event))
-                elif _unit_type in unit_type_dict_amon:
-                    unit_type_dict_amon[_unit_type][0] += 1
-                else:
-                    unit_type_dict_amon[_unit_type] = [1,0,0,0]
+        # Save stats for units created
+        if main_player == _control_pid:
+            unit_counts_main.add(_unit_type, 0)
 
-            # Outlaw order
-            if _unit_type in tychus_outlaws and _control_pid in [1,2] and not(_unit_type in outlaw_order):
-                outlaw_order.append(_unit_type)
+        if ally_player == _control_pid:
+            unit_counts_ally.add(_unit_type, 0)
 
-            # Identifying waves
-            if _control_pid in [3,4,5,6] and event['_gameloop']/16 > START_TIME + 60 and _unit_type in UnitsInWaves:
-                if wave_units['second'] == event['_gameloop']/16:
-                    wave_units['units'].append(_unit_type)
-                else:
-                    wave_units['second'] = event['_gameloop']/16
-                    wave_units['units'] = [_unit_type]
+        if _control_pid in amon_players:
+            if _ability_name == 'MutatorAmonDehakaDrag':
+                MutatorDehakaDragUnitIDs.add(uid)
+            else:
+                unit_counts_amon.add(_unit_type, 0)
 
-                if len(wave_units['units']) > 5:
-                    identified_waves[event['_gameloop']/16] = wave_units['units']
+        # Outlaw order
+        if _unit_type in tychus_outlaws and _control_pid in [1,2] and not(_unit_type in outlaw_order):
+            outlaw_order.append(_unit_type)
 
-            # Abathur biomass for identifying locust
-            if _unit_type == 'BiomassPickup' :
-                LastBiomassPosition = [event['m_x'], event['m_y'], event['_gameloop']]
+        # Identifying waves
+        if _control_pid in [3,4,5,6] and seconds > START_TIME + 60 and _unit_type in UnitsInWaves:
+            if wave_units['second'] == seconds:
+                wave_units['units'].append(_unit_type)
+            else:
+                wave_units['second'] = seconds
+                wave_units['units'] = [_unit_type]
 
-            if _unit_type == 'Locust' and [event['m_x'], event['m_y'], event['_gameloop']] == LastBiomassPosition:
-                AbathurKillLocusts.add(unitid(event))
+            if len(wave_units['units']) > 5:
+                identified_waves[seconds] = wave_units['units']
 
+        # Abathur biomass for identifying locust
+        if _unit_type == 'BiomassPickup' :
+            LastBiomassPosition = [event['m_x'], event['m_y'], event['_gameloop']]
+
+        if _unit_type == 'Locust' and [event['m_x'], event['m_y'], event['_gameloop']] == LastBiomassPosition:
+            AbathurKillLocusts.add(uid)
+
+
+    def unit_initialized(event, uid, seconds):
         # In future ignore some Dark/High Templar deaths caused by Archon merge
-        if event['_event'] == 'NNet.Replay.Tracker.SUnitInitEvent' and event['m_unitTypeName'].decode() == "Archon":
+        if unit_dict.name(event['m_unitTypeName']) == "Archon":
             DT_HT_Ignore[event['m_controlPlayerId']] += 2
 
 
-        if event['_event'] == 'NNet.Replay.Tracker.SUnitTypeChangeEvent' and unitid(event) in unit_dict:
-                _old_unit_type = unit_dict[unitid(event)][0]
-                _control_pid = unit_dict[unitid(event)][1]
-                _unit_type = event['m_unitTypeName'].decode()
+    def unit_type_changed(event, uid, seconds):
+        nonlocal ResearchVesselLandedTiming
+        if not uid in unit_dict:
+            return
+
+        _old_unit_type = unit_dict.type(uid)
+        _control_pid = unit_dict.owner(uid)
+        _unit_type = unit_dict.name(event['m_unitTypeName'])
+
+        # Void Launch bonus objective. If it lands and soon-ish after takes off, the bonus is complete.
+        if _control_pid == 7 and _unit_type == 'ResearchVesselLanded':
+            ResearchVesselLandedTiming = event['_gameloop']
 
-                # Void Launch bonus objective. If it lands and soon-ish after takes off, the bonus is complete.
-                if _control_pid == 7 and _unit_type == 'ResearchVesselLanded':
-                    ResearchVesselLandedTiming = event['_gameloop']
+        if _control_pid == 7 and _unit_type == 'ResearchVessel' and ResearchVesselLandedTiming != None and (ResearchVesselLandedTiming + 1100 > event['_gameloop']):
+            bonus_timings.append(seconds - START_TIME)
+            ResearchVesselLandedTiming = None
 
-                if _control_pid == 7 and _unit_type == 'ResearchVessel' and ResearchVesselLandedTiming != None and (ResearchVesselLandedTiming + 1100 > event['_gameloop']):
-                    bonus_timings.append(event['_gameloop']/16 - START_TIME)
-                    ResearchVesselLandedTiming = None
+        # Scythe of Amon bonus objective. If it changes to WarpPrismPhasing, the bonus is completed.
+        if 'Scythe of Amon' in replay['map_name'] and _control_pid == 11 and _unit_type == 'WarpPrismPhasing':
+            bonus_timings.append(seconds - START_TIME)
 
-                # Scythe of Amon bonus objective. If it changes to WarpPrismPhasing, the bonus is completed.
-                if 'Scythe of Amon' in replay['map_name'] and _control_pid == 11 and _unit_type == 'WarpPrismPhasing':
-                    bonus_timings.append(event['_gameloop']/16 - START_TIME)                    
+        # Strange. Some units morph to egg, then the morph is created, then the egg morphs back and the unit is killed
+        if _unit_type in units_killed_in_morph:
+            return
 
-                # Strange. Some units morph to egg, then the morph is created, then the egg morphs back and the unit is killed
-                if _unit_type in units_killed_in_morph:
-                    continue
+        # Update unit_dict
+        unit_dict.set_type(uid, _unit_type)
 
-                # Update unit_dict
-                unit_dict[unitid(event)][0] = _unit_type
+        # Add to created units
+        if _unit_type in UnitNameDict and _old_unit_type in UnitNameDict:
 
-                # Add to created units
-                if _unit_type in UnitNameDict and _old_unit_type in UnitNameDict:
+            # Don't add into created units if it's just a morph
+            # Don't count wreckages morhping back
+            if UnitNameDict[_unit_type] != UnitNameDict[_old_unit_type] and not _old_unit_type in UnitAddLossesTo:
 
-                    # Don't add into created units if it's just a morph
-                    # Don't count wreckages morhping back
-                    if UnitNameDict[_unit_type] != UnitNameDict[_old_unit_type] and not _old_unit_type in UnitAddLossesTo: 
+                # Increase unit type created for controlling player
+                if main_player == _control_pid:
+                    unit_counts_main.add(_unit_type, 0)
+
+                if ally_player == _control_pid:
+                    unit_counts_ally.add(_unit_type, 0)
+
+                if _control_pid in amon_players:
+                    unit_counts_amon.add(_unit_type, 0)
+            else:
+                if main_player == _control_pid:
+                    unit_counts_main.add(_unit_type, 0, 0)
 
-                        # Increase unit type created for controlling player
-                        if main_player == _control_pid:
-                            if _unit_type in unit_type_dict_main:
-                                unit_type_dict_main[_unit_type][0] += 1
-                            else:
-                                unit_type_dict_main[_unit_type] = [1,0,0,0]
+                if ally_player == _control_pid:
+                    unit_counts_ally.add(_unit_type, 0, 0)
 
-                        if ally_player == _control_pid:
-                            if _unit_type in unit_type_dict_ally:
-                                unit_type_dict_ally[_unit_type][0] += 1
-                            else:
-                                unit_type_dict_ally[_unit_type] = [1,0,0,0]
+                if _control_pid in amon_players:
+                    unit_counts_amon.add(_unit_type, 0, 0)
 
-                        if _control_pid in amon_players:
-                            if _unit_type in unit_type_dict_amon:
-                                unit_type_dict_amon[_unit_type][0] += 1
-                            else:
-                                unit_type_dict_amon[_unit_type] = [1,0,0,0]
-                    else:
-                        if main_player == _control_pid and not(_unit_type in unit_type_dict_main):
-                            unit_type_dict_main[_unit_type] = [0,0,0,0]
 
-                        if ally_player == _control_pid and not(_unit_type in unit_type_dict_ally):
-                            unit_type_dict_ally[_unit_type] = [0,0,0,0]
+    def unit_owner_changed(event, uid, seconds):
+        if not uid in unit_dict:
+            return
 
-                        if _control_pid in amon_players and not(_unit_type in unit_type_dict_amon):
-                            unit_type_dict_amon[_unit_type] = [0,0,0,0]
+        # Mind-controlled units
+        _losing_player = unit_dict.owner(uid)
 
+        if event['m_controlPlayerId'] == main_player and _losing_player in amon_players:
+            if not 'mc' in replay_report_dict['mainIcons']:
+                replay_report_dict['mainIcons']['mc'] = 1
+            else:
+                replay_report_dict['mainIcons']['mc'] += 1
+        elif event['m_controlPlayerId'] == ally_player and _losing_player in amon_players:
+            if not 'mc' in replay_report_dict['allyIcons']:
+                replay_report_dict['allyIcons']['mc'] = 1
+            else:
+                replay_report_dict['allyIcons']['mc'] += 1
 
         # Update ownership
-        if event['_event'] == 'NNet.Replay.Tracker.SUnitOwnerChangeEvent' and unitid(event) in unit_dict:
+        unit_dict.set_owner(uid, event['m_controlPlayerId'])
 
-            # Mind-controlled units
-            _losing_player = unit_dict[unitid(event)][1]
-            # _unit = unit_dict[unitid(event)][0]
-            # logger.info(f"{_unit} ({_losing_player}) mind-controlled by {event['m_controlPlayerId']}")
+        # Malwarfare bonus objective. First save when the bonus started, then check if it was completed sooner than 245.9375
+        if 'Malwarfare' in replay['map_name']:
+            _time = seconds - START_TIME
+            if event['m_controlPlayerId'] == 9:
+                MWBonusInitialTiming[0] = _time
+            elif event['m_controlPlayerId'] == 10:
+                MWBonusInitialTiming[1] = _time
+            elif event['m_controlPlayerId'] == 6 and (_time - MWBonusInitialTiming[0] < 245.9375 or _time - MWBonusInitialTiming[1] < 245.9375):
+                bonus_timings.append(_time)
 
-            if event['m_controlPlayerId'] == main_player and _losing_player in amon_players:
-                if not 'mc' in replay_report_dict['mainIcons']:
-                    replay_report_dict['mainIcons']['mc'] = 1
-                else:
-                    replay_report_dict['mainIcons']['mc'] += 1
-            elif event['m_controlPlayerId'] == ally_player and _losing_player in amon_players:
-                if not 'mc' in replay_report_dict['allyIcons']:
-                    replay_report_dict['allyIcons']['mc'] = 1
+
+    def unit_died_killcount(event, uid, seconds):
+        # Update some kill stats
+        try:
+            _killed_unit_type = unit_dict.type(uid)
+            _losing_player = unit_dict.owner(uid)
+            _killing_player = event['m_killerPlayerId']
+
+            # Count kills for players
+            if _killing_player != None and not _killed_unit_type in ['FuelCellPickupUnit','ForceField']:
+                if _killing_player in (1,2) and not _losing_player in amon_players:
+                    pass
+                elif _killing_player in amon_players and not _losing_player in (1,2):
+                    pass
                 else:
-                    replay_report_dict['allyIcons']['mc'] += 1
+                    killcounts[_killing_player] += 1
 
-            # Update ownership
-            unit_dict[unitid(event)][1] = event['m_controlPlayerId']
+            # Get last_aoe_unit_killed (used when player units die without a killing unit, it was likely some enemy caster casting persistent AoE spell)
+            if _killed_unit_type in aoe_units and _killing_player in [1,2] and _losing_player in amon_players and uid != None:
+                last_aoe_unit_killed[_losing_player] = [_killed_unit_type, seconds]
 
-            # Malwarfare bonus objective. First save when the bonus started, then check if it was completed sooner than 245.9375
-            if 'Malwarfare' in replay['map_name']:
-                _time = event['_gameloop']/16 - START_TIME
-                if event['m_controlPlayerId'] == 9:
-                    MWBonusInitialTiming[0] = _time
-                elif event['m_controlPlayerId'] == 10:
-                    MWBonusInitialTiming[1] = _time
-                elif event['m_controlPlayerId'] == 6 and (_time - MWBonusInitialTiming[0] < 245.9375 or _time - MWBonusInitialTiming[1] < 245.9375):
-                    bonus_timings.append(_time)
+        except:
+            logger.error(traceback.format_exc())
 
-        # Update some kill stats
-        if event['_event'] == 'NNet.Replay.Tracker.SUnitDiedEvent':
-            try:
-                _killed_unit_type = unit_dict[unitid(event)][0]
-                _losing_player = unit_dict[unitid(event)][1]
-                _killing_player = event['m_killerPlayerId']
-
-                # Count kills for players
-                if _killing_player != None and not _killed_unit_type in ['FuelCellPickupUnit','ForceField']:
-                    if _killing_player in (1,2) and not _losing_player in amon_players:
-                        pass
-                    elif _killing_player in amon_players and not _losing_player in (1,2):
-                        pass   
-                    else:
-                        killcounts[_killing_player] += 1
-
-                # Get last_aoe_unit_killed (used when player units die without a killing unit, it was likely some enemy caster casting persistent AoE spell)
-                if _killed_unit_type in aoe_units and _killing_player in [1,2] and _losing_player in amon_players and unitid(event) != None:
-                    last_aoe_unit_killed[_losing_player] = [_killed_unit_type, event['_gameloop']/16]
-
-            except:
-                logger.error(traceback.format_exc())
 
+    def unit_died(event, uid, seconds):
         # More kill stats
-        if event['_event'] == 'NNet.Replay.Tracker.SUnitDiedEvent' and unitid(event) in unit_dict:
-            try:
-                _killing_unit_id = unitid(event, killer=True)
-                _killing_player = event['m_killerPlayerId']
-                _killed_unit_type = unit_dict[unitid(event)][0]
-                _losing_player = int(unit_dict[unitid(event)][1])
-                _commander = commander_fallback.get(_killing_player,None)
-
-                # Get killing unit
-                if _killing_unit_id in unit_dict and unitid(event) != None: # We have a killing unit
-                    _killing_unit_type = unit_dict[_killing_unit_id][0]
-                else:
-                    """
-                    For no-unit, check if we default to some commander no-unit like airstrike, or use 'NoUnit'
-                    But lets use this only rarely. Units killed in transports count for this as well.
-                    Other not counted sources: Dusk Wings lifting off, CoD explosion, ...
-                    """
-                    _killing_unit_type = commander_no_units.get(_commander,'NoUnit')
-
-                # Killbot feed
-                if _killing_unit_type in ['MutatorKillBot','MutatorDeathBot','MutatorMurderBot'] and _losing_player in [1,2]:
-                    killbot_feed[_losing_player] += 1
-
-                # Abathur locusts
-                if _killing_unit_type == 'Locust' and _commander == 'Abathur' and not _killing_unit_id in AbathurKillLocusts:
-                    _killing_unit_type = 'SwarmHost'
-
-                # Custom kill count
-                if _killing_player in [1,2] and _losing_player in amon_players:
-                    if _killed_unit_type in HFTS_Units:
-                        if not 'hfts' in custom_kill_count:
-                            custom_kill_count['hfts'] = {1:0,2:0}
-                        custom_kill_count['hfts'][_killing_player] += 1
-
-                    if _killed_unit_type in TUS_Units:
-                        if not 'tus' in custom_kill_count:
-                            custom_kill_count['tus'] = {1:0,2:0}
-                        custom_kill_count['tus'][_killing_player] += 1
-
-                    elif _killed_unit_type == 'MutatorPropagator':
-                        if not 'propagators' in custom_kill_count:
-                            custom_kill_count['propagators'] = {1:0,2:0}
-                        custom_kill_count['propagators'][_killing_player] += 1
-
-                    elif _killed_unit_type in ['MutatorSpiderMine','MutatorSpiderMineBurrowed','WidowMineBurrowed','WidowMine']:
-                        if not 'minesweeper' in custom_kill_count:
-                            custom_kill_count['minesweeper'] = {1:0,2:0}
-                        custom_kill_count['minesweeper'][_killing_player] += 1
-
-                    elif _killed_unit_type == 'MutatorVoidRift':
-                        if not 'voidrifts' in custom_kill_count:
-                            custom_kill_count['voidrifts'] = {1:0,2:0}
-                        custom_kill_count['voidrifts'][_killing_player] += 1
-
-                    elif _killed_unit_type in ['MutatorTurkey','MutatorTurking','MutatorInfestedTurkey']:
-                        if not 'turkey' in custom_kill_count:
-                            custom_kill_count['turkey'] = {1:0,2:0}
-                        custom_kill_count['turkey'][_killing_player] += 1
-
-                    elif _killed_unit_type == 'MutatorVoidReanimator':
-                        if not 'voidreanimators' in custom_kill_count:
-                            custom_kill_count['voidreanimators'] = {1:0,2:0}
-                        custom_kill_count['voidreanimators'][_killing_player] += 1
-
-                    elif _killed_unit_type in ['InfestableBiodome','JarbanInfestibleColonistHut','InfestedMercHaven','InfestableHut']:
-                        if not 'deadofnight' in custom_kill_count:
-                            custom_kill_count['deadofnight'] = {1:0,2:0}
-                        custom_kill_count['deadofnight'][_killing_player] += 1
-
-                # If an enemy mutator spider mine kills something, counts a kill for the first player who lost a unit to it
-                if _losing_player in [1,2] and _killing_player in amon_players:
-                    if _killing_unit_type == 'MutatorSpiderMine' and not _killing_unit_id in UsedMutatorSpiderMines:
-                        UsedMutatorSpiderMines.add(_killing_unit_id) # Count each mutator spider mine only once
-                        if not 'minesweeper' in custom_kill_count:
-                            custom_kill_count['minesweeper'] = {1:0,2:0}
-                        custom_kill_count['minesweeper'][_losing_player] += 1
-
-                """Fix kills for some enemy area-of-effect units that kills player units after they are dead.
-                   This is the best guess, if one of aoe_units died recently, it was likely that one. """
-                if _killing_unit_type == 'NoUnit' and _killing_unit_id == None and _killing_player in amon_players and _losing_player != _killing_player:
-                    if event['_gameloop']/16 - last_aoe_unit_killed[_killing_player][1] < 9 and last_aoe_unit_killed[_killing_player][0] != None:
-                        unit_type_dict_amon[last_aoe_unit_killed[_killing_player][0]][2] += 1
-                        logger.debug(f'{last_aoe_unit_killed[_killing_player][0]}({_killing_player}) killed {_killed_unit_type} | {event["_gameloop"]/16}s')
-
-                # Update unit kill stats
-                if ((_killing_unit_id in unit_dict) or _killing_unit_type in commander_no_units.values()) and (_killing_unit_id != unitid(event)) and _losing_player != _killing_player and _killed_unit_type != 'FuelCellPickupUnit':
-                    if main_player == _killing_player and _losing_player in amon_players:
-                        if _killing_unit_type in unit_type_dict_main:
-                            unit_type_dict_main[_killing_unit_type][2] += 1
-                        else:
-                            unit_type_dict_main[_killing_unit_type] = [0,0,1,0]
-
-                    if ally_player == _killing_player and _losing_player in amon_players:
-                        if _killing_unit_type in unit_type_dict_ally:
-                            unit_type_dict_ally[_killing_unit_type][2] += 1
-                        else:
-                            unit_type_dict_ally[_killing_unit_type] = [0,0,1,0]
-
-                    if _killing_player in amon_players and _losing_player in (1,2):
-                        if _killing_unit_type in unit_type_dict_amon:
-                            unit_type_dict_amon[_killing_unit_type][2] += 1
-                        else:
-                            unit_type_dict_amon[_killing_unit_type] = [0,0,1,0]
-
-                # Debug for player no units kills
-                # if _killed_unit_type not in {'Scarab','Interceptor'} and not _killing_unit_id in unit_dict and not _killing_unit_type in commander_no_units.values() and _killing_player in {1,2} and _losing_player != _killing_player:
-                #     logger.debug(f'{_killing_unit_type} ({_killing_player}|{commander_fallback.get(_killing_player,"")}) killed {_killed_unit_type} ({_losing_player}) - {event["m_x"]}x{event["m_y"]} - {event["_gameloop"]/16:.1f}s ')
-
-                # Update unit death stats
-                # Don't count self kills like Fenix switching suits
-                if _killed_unit_type in self_killing_units and _killing_player == None:
-                    if main_player == _losing_player:
-                        unit_type_dict_main[_killed_unit_type][0] -= 1
-                    if ally_player == _losing_player:
-                        unit_type_dict_ally[_killed_unit_type][0] -= 1
-                    continue
-
-                # Fix for units like Raptorlings that are counted each time they jump (as death and birth)
-                if event['_gameloop']/16 > 0 and _killed_unit_type in duplicating_units and _killed_unit_type == _killing_unit_type and _losing_player == _killing_player:
-                    if main_player == _losing_player:
-                        unit_type_dict_main[_killed_unit_type][0] -= 1
-                        continue
-                    if ally_player == _losing_player:
-                        unit_type_dict_ally[_killed_unit_type][0] -= 1
-                        continue
-                    if _killing_player in amon_players:
-                        unit_type_dict_amon[_killed_unit_type][0] -= 1
-                        continue
-
-                # In case of death caused by Archon merge, ignore these kills
-                if (_killed_unit_type == 'HighTemplar' or _killed_unit_type == 'DarkTemplar') and DT_HT_Ignore[_losing_player] > 0:
-                    DT_HT_Ignore[_losing_player] -= 1
-                    continue
+        if not uid in unit_dict:
+            return
 
+        try:
+            _killing_unit_id = unitid(event, killer=True)
+            _killing_player = event['m_killerPlayerId']
+            _killed_unit_type = unit_dict.type(uid)
+            _losing_player = int(unit_dict.owner(uid))
+            _commander = commander_fallback.get(_killing_player,None)
+
+            # Get killing unit
+            if _killing_unit_id in unit_dict and uid != None: # We have a killing unit
+                _killing_unit_type = unit_dict.type(_killing_unit_id)
+            else:
                 """
-                Bonus objectives
-                Mostly kills here. Sometimes checking killing player to prevent despawns from counting.
-                In case of trains, killing player is almost always None, and so I'm checking the position of the train.
-
+                For no-unit, check if we default to some commander no-unit like airstrike, or use 'NoUnit'
+                But lets use this only rarely. Units killed in transports count for this as well.
+                Other not counted sources: Dusk Wings lifting off, CoD explosion, ...
                 """
-                if ('Void Thrashing' in replay['map_name'] and _killed_unit_type in {'ArchAngelCoopFighter','ArchAngelCoopAssault'} and _losing_player == 5) or \
-                   ('Dead of Night' in replay['map_name'] and 'ACVirophage' == _killed_unit_type and _losing_player == 7 and _killing_player in {1,2}) or \
-                   (('Lock & Load' in replay['map_name'] or '[MM] LnL' in replay['map_name']) and 'XelNagaConstruct' == _killed_unit_type and _losing_player == 3) or \
-                   ('Chain of Ascension' in replay['map_name'] and 'SlaynElemental' == _killed_unit_type and _losing_player == 10 and _killing_player in {1,2}) or \
-                   ('Rifts to Korhal' in replay['map_name'] and 'ACPirateCapitalShip' == _killed_unit_type and _losing_player == 8 and _killing_player in {1,2}) or \
-                   ('Cradle of Death' in replay['map_name'] and 'LogisticsHeadquarters' == _killed_unit_type and _losing_player == 3) or \
-                   ('Part and Parcel' in replay['map_name'] and _killed_unit_type in {'Caboose','TarsonisEngine'} and not round(event['_gameloop']/16 - START_TIME,0) in bonus_timings and _losing_player == 8 and not (event['m_x'] == 169 and event['m_y'] == 99) and not (event['m_x'] == 38 and event['m_y'] == 178)) or \
-                   ('Oblivion Express' in replay['map_name'] and 'TarsonisEngineFast' == _killed_unit_type and _losing_player == 7 and event['m_x'] < 196) or \
-                   ('Mist Opportunities' in replay['map_name'] and 'COOPTerrazineTank' == _killed_unit_type and _losing_player == 3 and _killing_player in {1,2}) or \
-                   ('The Vermillion Problem' in replay['map_name'] and _killed_unit_type in {'RedstoneSalamander','RedstoneSalamanderBurrowed'} and _losing_player == 9 and _killing_player in {1,2}) or \
-                   ('Miner Evacuation' in replay['map_name'] and _killed_unit_type == 'Blightbringer' and  _losing_player == 5 and _killing_player in {1,2}) or \
-                   ('Miner Evacuation' in replay['map_name'] and _killed_unit_type == 'NovaEradicator' and  _losing_player == 9 and unit_type_dict_amon[_killed_unit_type][1] == 1 and _killing_player in {1,2}) or \
-                   ('Temple of the Past' in replay['map_name'] and 'ZenithStone' == _killed_unit_type and _losing_player == 8):
-
-                    # Time offset for Cradle of Death as the explosion is delayed
-                    if 'Cradle of Death' in replay['map_name']: 
-                        bonus_timings.append(round(event['_gameloop']/16 - START_TIME - 8,0))
-                    else:
-                        bonus_timings.append(round(event['_gameloop']/16 - START_TIME,0))
-                    
-                    logger.debug(f'-------------\nBO: {_killed_unit_type} ({_losing_player}) killed by {_killing_player} ({event["_gameloop"]/16/60:.2f})min\n{event}\n-------------')
-
-                # Add deaths  
-
-                # Don't include salvage  
-                if _killed_unit_type in salvage_units and _losing_player == _killing_player:
-                    continue
-
-                # Add
-                if main_player == _losing_player and event['_gameloop']/16 > 0 and event['_gameloop']/16 > START_TIME+1: # Don't count deaths on game init
-                    if _killed_unit_type in unit_type_dict_main:
-                        unit_type_dict_main[_killed_unit_type][1] += 1
-                    else:
-                        unit_type_dict_main[_killed_unit_type] = [0,1,0,0]
-
-                if ally_player == _losing_player and event['_gameloop']/16 > 0 and event['_gameloop']/16 > START_TIME+1:
-                    if _killed_unit_type in unit_type_dict_ally:
-                        unit_type_dict_ally[_killed_unit_type][1] += 1
-                    else:
-                        unit_type_dict_ally[_killed_unit_type] = [0,1,0,0]
-
-                if _losing_player in amon_players and event['_gameloop']/16 > 0 and event['_gameloop']/16 > START_TIME+1 and not unitid(event) in MutatorDehakaDragUnitIDs:
-                    if _killed_unit_type in unit_type_dict_amon:
-                        unit_type_dict_amon[_killed_unit_type][1] += 1
-                    else:
-                        unit_type_dict_amon[_killed_unit_type] = [0,1,0,0]
-
-            except:
-                logger.error(traceback.format_exc())
+                _killing_unit_type = commander_no_units.get(_commander,'NoUnit')
+
+            # Killbot feed
+            if _killing_unit_type in ['MutatorKillBot','MutatorDeathBot','MutatorMurderBot'] and _losing_player in [1,2]:
+                killbot_feed[_losing_player] += 1
+
+            # Abathur locusts
+            if _killing_unit_type == 'Locust' and _commander == 'Abathur' and not _killing_unit_id in AbathurKillLocusts:
+                _killing_unit_type = 'SwarmHost'
+
+            # Custom kill count
+            if _killing_player in [1,2] and _losing_player in amon_players:
+                if _killed_unit_type in HFTS_Units:
+                    if not 'hfts' in custom_kill_count:
+                        custom_kill_count['hfts'] = {1:0,2:0}
+                    custom_kill_count['hfts'][_killing_player] += 1
+
+                if _killed_unit_type in TUS_Units:
+                    if not 'tus' in custom_kill_count:
+                        custom_kill_count['tus'] = {1:0,2:0}
+                    custom_kill_count['tus'][_killing_player] += 1
+
+                elif _killed_unit_type == 'MutatorPropagator':
+                    if not 'propagators' in custom_kill_count:
+                        custom_kill_count['propagators'] = {1:0,2:0}
+                    custom_kill_count['propagators'][_killing_player] += 1
+
+                elif _killed_unit_type in ['MutatorSpiderMine','MutatorSpiderMineBurrowed','WidowMineBurrowed','WidowMine']:
+                    if not 'minesweeper' in custom_kill_count:
+                        custom_kill_count['minesweeper'] = {1:0,2:0}
+                    custom_kill_count['minesweeper'][_killing_player] += 1
+
+                elif _killed_unit_type == 'MutatorVoidRift':
+                    if not 'voidrifts' in custom_kill_count:
+                        custom_kill_count['voidrifts'] = {1:0,2:0}
+                    custom_kill_count['voidrifts'][_killing_player] += 1
+
+                elif _killed_unit_type in ['MutatorTurkey','MutatorTurking','MutatorInfestedTurkey']:
+                    if not 'turkey' in custom_kill_count:
+                        custom_kill_count['turkey'] = {1:0,2:0}
+                    custom_kill_count['turkey'][_killing_player] += 1
+
+                elif _killed_unit_type == 'MutatorVoidReanimator':
+                    if not 'voidreanimators' in custom_kill_count:
+                        custom_kill_count['voidreanimators'] = {1:0,2:0}
+                    custom_kill_count['voidreanimators'][_killing_player] += 1
+
+                elif _killed_unit_type in ['InfestableBiodome','JarbanInfestibleColonistHut','InfestedMercHaven','InfestableHut']:
+                    if not 'deadofnight' in custom_kill_count:
+                        custom_kill_count['deadofnight'] = {1:0,2:0}
+                    custom_kill_count['deadofnight'][_killing_player] += 1
+
+            # If an enemy mutator spider mine kills something, counts a kill for the first player who lost a unit to it
+            if _losing_player in [1,2] and _killing_player in amon_players:
+                if _killing_unit_type == 'MutatorSpiderMine' and not _killing_unit_id in UsedMutatorSpiderMines:
+                    UsedMutatorSpiderMines.add(_killing_unit_id) # Count each mutator spider mine only once
+                    if not 'minesweeper' in custom_kill_count:
+                        custom_kill_count['minesweeper'] = {1:0,2:0}
+                    custom_kill_count['minesweeper'][_losing_player] += 1
+
+            """Fix kills for some enemy area-of-effect units that kills player units after they are dead.
+               This is the best guess, if one of aoe_units died recently, it was likely that one. """
+            if _killing_unit_type == 'NoUnit' and _killing_unit_id == None and _killing_player in amon_players and _losing_player != _killing_player:
+                if seconds - last_aoe_unit_killed[_killing_player][1] < 9 and last_aoe_unit_killed[_killing_player][0] != None:
+                    unit_counts_amon.add_existing(last_aoe_unit_killed[_killing_player][0], 2, 1)
+                    logger.debug(f'{last_aoe_unit_killed[_killing_player][0]}({_killing_player}) killed {_killed_unit_type} | {seconds}s')
+
+            # Update unit kill stats
+            if ((_killing_unit_id in unit_dict) or _killing_unit_type in commander_no_units.values()) and (_killing_unit_id != uid) and _losing_player != _killing_player and _killed_unit_type != 'FuelCellPickupUnit':
+                if main_player == _killing_player and _losing_player in amon_players:
+                    unit_counts_main.add(_killing_unit_type, 2)
+
+                if ally_player == _killing_player and _losing_player in amon_players:
+                    unit_counts_ally.add(_killing_unit_type, 2)
+
+                if _killing_player in amon_players and _losing_player in (1,2):
+                    unit_counts_amon.add(_killing_unit_type, 2)
+
+            # Debug for player no units kills
+            # if _killed_unit_type not in {'Scarab','Interceptor'} and not _killing_unit_id in unit_dict and not _killing_unit_type in commander_no_units.values() and _killing_player in {1,2} and _losing_player != _killing_player:
+            #     logger.debug(f'{_killing_unit_type} ({_killing_player}|{commander_fallback.get(_killing_player,"")}) killed {_killed_unit_type} ({_losing_player}) - {event["m_x"]}x{event["m_y"]} - {seconds:.1f}s ')
+
+            # Update unit death stats
+            # Don't count self kills like Fenix switching suits
+            if _killed_unit_type in self_killing_units and _killing_player == None:
+                if main_player == _losing_player:
+                    unit_counts_main.add_existing(_killed_unit_type, 0, -1)
+                if ally_player == _losing_player:
+                    unit_counts_ally.add_existing(_killed_unit_type, 0, -1)
+                return
+
+            # Fix for units like Raptorlings that are counted each time they jump (as death and birth)
+            if seconds > 0 and _killed_unit_type in duplicating_units and _killed_unit_type == _killing_unit_type and _losing_player == _killing_player:
+                if main_player == _losing_player:
+                    unit_counts_main.add_existing(_killed_unit_type, 0, -1)
+                    return
+                if ally_player == _losing_player:
+                    unit_counts_ally.add_existing(_killed_unit_type, 0, -1)
+                    return
+                if _killing_player in amon_players:
+                    unit_counts_amon.add_existing(_killed_unit_type, 0, -1)
+                    return
+
+            # In case of death caused by Archon merge, ignore these kills
+            if (_killed_unit_type == 'HighTemplar' or _killed_unit_type == 'DarkTemplar') and DT_HT_Ignore[_losing_player] > 0:
+                DT_HT_Ignore[_losing_player] -= 1
+                return
+
+            # Bonus objectives
+            _bonus_rule = match_bonus_rule(map_bonus_rules, _killed_unit_type, _losing_player, _killing_player, event, seconds - START_TIME, unit_counts_amon, bonus_timings)
+            if _bonus_rule != None:
+                bonus_timings.append(round(seconds - START_TIME + _bonus_rule.offset,0))
+                logger.debug(f'-------------\nBO: {_killed_unit_type} ({_losing_player}) killed by {_killing_player} ({seconds/60:.2f})min\n{event}\n-------------')
+
+            # Add deaths
+
+            # Don't include salvage
+            if _killed_unit_type in salvage_units and _losing_player == _killing_player:
+                return
+
+            # Add
+            if main_player == _losing_player and seconds > 0 and seconds > START_TIME+1: # Don't count deaths on game init
+                unit_counts_main.add(_killed_unit_type, 1)
+
+            if ally_player == _losing_player and seconds > 0 and seconds > START_TIME+1:
+                unit_counts_ally.add(_killed_unit_type, 1)
+
+            if _losing_player in amon_players and seconds > 0 and seconds > START_TIME+1 and not uid in MutatorDehakaDragUnitIDs:
+                unit_counts_amon.add(_killed_unit_type, 1)
+
+        except:
+            logger.error(traceback.format_exc())
+
+
+    # Handlers for each event type. They are called in this order.
+    handlers = {'NNet.Replay.Tracker.SUpgradeEvent': (upgrade,),
+                'NNet.Replay.Tracker.SUnitBornEvent': (unit_created,),
+                'NNet.Replay.Tracker.SUnitInitEvent': (unit_created, unit_initialized),
+                'NNet.Replay.Tracker.SUnitTypeChangeEvent': (unit_type_changed,),
+                'NNet.Replay.Tracker.SUnitOwnerChangeEvent': (unit_owner_changed,),
+                'NNet.Replay.Tracker.SUnitDiedEvent': (unit_died_killcount, unit_died)}
+
+    for event in replay['events']:
+        event_handlers = handlers.get(event['_event'])
+        if event_handlers == None:
+            continue
+
+        # Skip events after the game ended
+        seconds = event['_gameloop']/16
+        if seconds > END_TIME:
+            continue
+
+        uid = unitid(event) if 'm_unitTagIndex' in event else None
+        for handler in event_handlers:
+            handler(event, uid, seconds)
+
+    unit_type_dict_main = unit_counts_main.to_dict()
+    unit_type_dict_ally = unit_counts_ally.to_dict()
+    unit_type_dict_amon = unit_counts_amon.to_dict()
 
     # pprint(unit_type_dict_main)
     # pprint(unit_type_dict_ally)
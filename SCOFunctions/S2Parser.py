@@ -1,14 +1,17 @@
-import os
 import mpyq
+import heapq
 import json
 import time
+import threading
 import traceback
 
 from s2protocol import versions
 from s2protocol.build import game_version as protocol_build
+from s2protocol.decoders import VersionedDecoder, CorruptedError
 from SCOFunctions.SC2Dictionaries import map_names, prestige_names
 from SCOFunctions.IdentifyMutators import identify_mutators
 from SCOFunctions.MLogging import logclass
+from SCOFunctions.MParseCache import parse_cache, replay_key
 
 logger = logclass('PARS','INFO')
 
@@ -25,27 +28,252 @@ def find_closest_values(number:int, llist:list, amount=2):
     return list(closest.values())[:amount]
 
 
-def get_last_deselect_event(events):
-    """ Returns the last deselect event in replay's events """
-    last_event = None
+class ProtocolRegistry:
+    """ Keeps loaded s2protocol modules per build and how long decoding with them takes """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.loaded = dict()
+        self.latest_protocol = None
+        self.latest_build = None
+        self.decode_time = dict()
+        self.resolved = dict()
+
+    def latest(self):
+        """ Returns the latest protocol and its build """
+        if self.latest_protocol == None:
+            self.latest_protocol = versions.latest()
+            self.latest_build = protocol_build().split('.')[-2]
+        return self.latest_protocol
+
+    def build(self, build):
+        """ Returns a protocol for the build or `None` if it's not available """
+        if not build in self.loaded:
+            with self.lock:
+                if not build in self.loaded:
+                    try:
+                        self.loaded[build] = versions.build(build)
+                    except:
+                        self.loaded[build] = None
+        return self.loaded[build]
+
+    def resolve(self, replay_build, try_lastest=True, try_closest=False):
+        """ Returns a protocol and build used for the replay build. Returns `(None, None)` if there is no suitable protocol.
+        Results are remembered, so fallbacks are found only once for each build. """
+        key = (replay_build, try_lastest, try_closest)
+        if not key in self.resolved:
+            base_build = valid_protocols.get(replay_build, replay_build)
+            if self.build(base_build) != None:
+                used_build = base_build
+            elif try_closest:
+                used_build = find_closest_values(base_build, protocols)[0]
+            elif try_lastest:
+                self.latest()
+                used_build = self.latest_build
+            else:
+                used_build = None
+            self.resolved[key] = used_build
+
+        used_build = self.resolved[key]
+        if used_build == None:
+            return None, None
+        if used_build == self.latest_build:
+            return self.latest(), used_build
+        return self.build(used_build), used_build
+
+    def prewarm(self, builds):
+        """ Loads protocols for builds in a background thread """
+        builds = [b for b in builds if isinstance(b, int) and not b in self.loaded]
+        if len(builds) == 0:
+            return
+        thread = threading.Thread(target=lambda: [self.build(b) for b in builds], daemon=True)
+        thread.start()
+        logger.debug(f'Prewarming {len(builds)} protocols')
+
+    def add_decode_time(self, build, seconds, count=1):
+        """ Adds decoding time for the build """
+        with self.lock:
+            old_count, total = self.decode_time.get(build, (0, 0))
+            self.decode_time[build] = (old_count + count, total + seconds)
+
+    def take_decode_time(self):
+        """ Returns decoding times {build: (count, total)} collected since the last call, used to pass them from worker processes """
+        with self.lock:
+            decode_time = self.decode_time
+            self.decode_time = dict()
+            return decode_time
+
+    def merge_decode_time(self, decode_time):
+        """ Adds decoding times from `take_decode_time` """
+        for build, (count, total) in decode_time.items():
+            self.add_decode_time(build, total, count=count)
+
+    def stats(self):
+        """ Returns decoding stats per build {build: {'count','total','average'}} """
+        return {build: {'count': count, 'total': total, 'average': total/count} for build, (count, total) in self.decode_time.items()}
+
+
+protocol_registry = ProtocolRegistry()
+
+
+def prewarm_protocols(builds):
+    """ Loads protocols for given builds in the background """
+    protocol_registry.prewarm(builds)
+
+
+def scan_events(events, return_events=False):
+    """ Goes through merged events once and returns a tuple:
+    start time, last deselect event, events used to identify mutators, all events (if `return_events`)
+
+    Start time is accurate based on upgrades and mineral collection as fallback.
+    """
+    start_time = None
+    last_deselect_event = None
+    mutator_events = list()
+    all_events = list() if return_events else None
+
     for event in events:
+        if return_events:
+            all_events.append(event)
+
         if event['_event'] == 'NNet.Game.SSelectionDeltaEvent':
-            last_event = event['_gameloop']/16 - 2 #16 gameloops per second, offset to coincide with speedrun timings more
+            last_deselect_event = event['_gameloop']/16 - 2 #16 gameloops per second, offset to coincide with speedrun timings more
+
+        elif event['_event'] == 'NNet.Game.STriggerDialogControlEvent':
+            mutator_events.append(event)
+
+        elif event['_event'] == 'NNet.Replay.Tracker.SUpgradeEvent':
+            mutator_events.append(event)
+            if start_time == None and event['m_playerId'] in [1,2] and 'Spray' in event['m_upgradeTypeName'].decode():
+                start_time = event['_gameloop']/16
+
+        elif start_time == None and event['_event'] == 'NNet.Replay.Tracker.SPlayerStatsEvent' and event['m_playerId'] == 1 and event['m_stats']['m_scoreValueMineralsCollectionRate'] > 0:
+            start_time = event['_gameloop']/16
+
+    start_time = start_time if start_time != None else 0
+    return start_time, last_deselect_event, mutator_events, all_events
+
+
+def required_event_types(victory, extension):
+    """ Returns a set of event types the parser needs for start time, game length and mutators """
+    event_types = {'NNet.Replay.Tracker.SPlayerStatsEvent', 'NNet.Replay.Tracker.SUpgradeEvent'}
+    if victory:
+        event_types.add('NNet.Game.SSelectionDeltaEvent')
+    if extension:
+        event_types.add('NNet.Game.STriggerDialogControlEvent')
+    return event_types
+
+
+def decode_tracker_events(contents, protocol, event_types):
+    """ Returns a generator of tracker events of given types. Tracker events use versioned encoding
+    that describes its own structure, so other events are skipped without being decoded. """
+    wanted = {eventid: value for eventid, value in protocol.tracker_event_types.items() if value[1] in event_types}
+    decoder = VersionedDecoder(contents, protocol.typeinfos)
+    gameloop = 0
+    while not decoder.done():
+        start_bits = decoder.used_bits()
+        gameloop += protocol._varuint32_value(decoder.instance(protocol.svaruint32_typeid))
+        eventid = decoder.instance(protocol.tracker_eventid_typeid)
+        if not eventid in protocol.tracker_event_types:
+            raise CorruptedError(f'eventid({eventid}) at {decoder}')
+
+        if not eventid in wanted:
+            decoder._skip_instance()
+            decoder.byte_align()
+            continue
+
+        typeid, typename = wanted[eventid]
+        event = decoder.instance(typeid)
+        event['_event'] = typename
+        event['_eventid'] = eventid
+        event['_gameloop'] = gameloop
+        decoder.byte_align()
+        event['_bits'] = decoder.used_bits() - start_bits
+        yield event
+
+
+def decode_events(archive, protocol, event_types=None):
+    """ Returns a generator of game and tracker events ordered by gameloop. Events are decoded as the generator is consumed.
+
+    If `event_types` is provided, streams without any of these types aren't decoded at all. Other tracker events
+    are skipped before decoding. Game events are bit-packed and can't be skipped, so they are decoded and then filtered. """
+    streams = (('replay.game.events', protocol.decode_replay_game_events, 'NNet.Game.'),
+               ('replay.tracker.events', protocol.decode_replay_tracker_events, 'NNet.Replay.Tracker.'))
+
+    decoded = list()
+    for file, decode, prefix in streams:
+        if event_types == None:
+            decoded.append(decode(archive.read_file(file)))
+        elif not any(e.startswith(prefix) for e in event_types):
+            continue
+        elif prefix == 'NNet.Replay.Tracker.' and hasattr(protocol, 'tracker_event_types'):
+            decoded.append(decode_tracker_events(archive.read_file(file), protocol, event_types))
+        else:
+            decoded.append(e for e in decode(archive.read_file(file)) if e['_event'] in event_types)
 
-    return last_event
+    # Both streams are already ordered. On the same gameloop game events go before tracker events.
+    return heapq.merge(*decoded, key=lambda x:x['_gameloop'])
 
 
-def get_start_time(events):
-    """ Returns accurate start time based on upgrades and mineral collection as fallback"""
-    for event in events:
-        if event['_event'] == 'NNet.Replay.Tracker.SPlayerStatsEvent' and event['m_playerId'] == 1 and event['m_stats']['m_scoreValueMineralsCollectionRate'] > 0:
-            return event['_gameloop']/16
-        if event['_event'] == 'NNet.Replay.Tracker.SUpgradeEvent' and event['m_playerId'] in [1,2] and 'Spray' in event['m_upgradeTypeName'].decode():
-            return event['_gameloop']/16
-    return 0
+def decode_archive(archive, protocol, header, player_info=None, detailed_info=None):
+    """ Decodes details, initData, metadata and messages of the replay. Already decoded details and initData can be passed.
+    Returns a dictionary in the format stored in the parse cache. """
+    if player_info == None:
+        player_info = protocol.decode_replay_details(archive.read_file('replay.details'))
+
+    if detailed_info == None:
+        detailed_info = protocol.decode_replay_initdata(archive.read_file('replay.initData'))
+
+    metadata = json.loads(archive.read_file('replay.gamemetadata.json'))
+    messages = list(protocol.decode_replay_message_events(archive.read_file('replay.message.events')))
+
+    return {'header': header, 'player_info': player_info, 'detailed_info': detailed_info, 'metadata': metadata, 'messages': messages}
+
+
+def probe_replay(file, try_lastest=True):
+    """ Checks whether the replay is a Blizzard co-op game without game recovery enabled.
+    Returns `None` if it is, otherwise a reason why it's rejected.
+
+    Only the header, details and initData are decoded, and only as long as needed.
+    Data of accepted replays are put into the parse cache, so parsing them afterwards doesn't decode them again.
+    """
+    if '[MM]' in file:
+        return 'MM map'
+
+    key = replay_key(file)
+    cached = parse_cache.get(key)
+    if cached != None:
+        header, player_info, detailed_info = cached['header'], cached['player_info'], cached['detailed_info']
+    else:
+        archive = mpyq.MPQArchive(file)
+        header = protocol_registry.latest().decode_replay_header(archive.header['user_data_header']['content'])
+
+    protocol, used_build = protocol_registry.resolve(header['m_version']['m_baseBuild'], try_lastest=try_lastest)
+    if protocol == None:
+        return 'unsupported build'
 
+    if cached == None:
+        player_info = protocol.decode_replay_details(archive.read_file('replay.details'))
 
-def s2_parse_replay(file, try_lastest=True, parse_events=True, onlyBlizzard=False, withoutRecoverEnabled=False, return_raw=False, return_events=False, try_closest=False):
+    if not player_info['m_isBlizzardMap']:
+        return 'not a Blizzard map'
+
+    if not player_info['m_disableRecoverGame']:
+        return 'game recovery enabled'
+
+    if cached == None:
+        detailed_info = protocol.decode_replay_initdata(archive.read_file('replay.initData'))
+
+    slots = detailed_info['m_syncLobbyState']['m_lobbyState']['m_slots'][:len(player_info['m_playerList'])]
+    if not any(slot['m_commander'].decode() != '' for slot in slots):
+        return 'no commander'
+
+    if cached == None:
+        parse_cache.put(key, decode_archive(archive, protocol, header, player_info=player_info, detailed_info=detailed_info))
+    return None
+
+
+def s2_parse_replay(file, try_lastest=True, parse_events=True, onlyBlizzard=False, withoutRecoverEnabled=False, return_raw=False, return_events=False, try_closest=False, use_cache=True, event_types=None):
     """ Function parsing the replay and returning a replay class
 
     `try_lastest=False` doesn't try the lastest protocol version
@@ -54,38 +282,44 @@ def s2_parse_replay(file, try_lastest=True, parse_events=True, onlyBlizzard=Fals
     `withoutRecoverEnabled = True` returns `None` for games with game recovery enabled
     `return_raw = True` returns raw data as well
     `return_events = True` returns events as well
+    `use_cache = False` decodes the replay even if it's in the parse cache
+    `event_types` is a set of event names (`_event`) to return. Other events are skipped, except those the parser needs itself.
+    Unwanted tracker events aren't decoded, game events are decoded and filtered afterwards (see `decode_events`).
     """
 
     # Exit straight away if onlyBlizzard enforced
     if onlyBlizzard and '[MM]' in file:
         return None 
 
-    # Open archive
-    archive = mpyq.MPQArchive(file)
-    contents = archive.header['user_data_header']['content']
+    # Get decoded data from the cache or open the archive
+    key = replay_key(file)
+    cached = parse_cache.get(key) if use_cache else None
+    archive = None
+
+    if cached == None:
+        archive = mpyq.MPQArchive(file)
+        contents = archive.header['user_data_header']['content']
+        header = protocol_registry.latest().decode_replay_header(contents)
+    else:
+        header = cached['header']
 
-    header = versions.latest().decode_replay_header(contents)
     replay_build = header['m_version']['m_baseBuild']
 
     # If the build is in a known list of protocols that aren't included but work, replace the build by the version that works.
-    base_build = valid_protocols.get(replay_build, replay_build)
-
-    try:
-        protocol = versions.build(base_build)
-        used_build = base_build
-    except:
-        if try_closest:
-            used_build = find_closest_values(base_build, valid_protocols)[0]
-            protocol = versions.build(used_build)
-        elif try_lastest:
-            protocol = versions.latest()
-            used_build = protocol_build().split('.')[-2]
-        else:
-            return None
+    protocol, used_build = protocol_registry.resolve(replay_build, try_lastest=try_lastest, try_closest=try_closest)
+    if protocol == None:
+        return None
 
-    # Get player info
-    player_info = archive.read_file('replay.details')
-    player_info = protocol.decode_replay_details(player_info)
+    decode_start = time.time()
+    if cached == None:
+        cached = decode_archive(archive, protocol, header)
+        if use_cache:
+            parse_cache.put(key, cached)
+
+    player_info = cached['player_info']
+    detailed_info = cached['detailed_info']
+    metadata = cached['metadata']
+    messages = cached['messages']
 
     # Exit if onlyBlizzard maps enforced
     if onlyBlizzard and not player_info['m_isBlizzardMap']:
@@ -95,36 +329,26 @@ def s2_parse_replay(file, try_lastest=True, parse_events=True, onlyBlizzard=Fals
     if withoutRecoverEnabled and not player_info['m_disableRecoverGame']:
         return None
 
-    # Get detailed info
-    detailed_info = archive.read_file('replay.initData')
-    detailed_info = protocol.decode_replay_initdata(detailed_info)
-
-    # Get metadata
-    metadata = json.loads(archive.read_file('replay.gamemetadata.json'))
-
-    # Messages
-    messages = archive.read_file('replay.message.events')
-    messages = protocol.decode_replay_message_events(messages)
+    victory = metadata['Players'][0]['Result'] == 'Win' or metadata['Players'][1]['Result'] == 'Win'
+    extension = detailed_info['m_syncLobbyState']['m_gameDescription']['m_hasExtensionMod']
 
-    events = list()
+    start_time, last_deselect_event, mutator_events, events = 0, None, list(), list()
     if parse_events:
-        # Get game events
-        game_events = archive.read_file('replay.game.events')
-        game_events = protocol.decode_replay_game_events(game_events)  
+        if archive == None:
+            archive = mpyq.MPQArchive(file)
 
-        # Get tracker events
-        tracker_events = archive.read_file('replay.tracker.events')
-        tracker_events = protocol.decode_replay_tracker_events(tracker_events) 
+        if event_types != None:
+            event_types = set(event_types) | required_event_types(victory, extension)
+        start_time, last_deselect_event, mutator_events, events = scan_events(decode_events(archive, protocol, event_types), return_events=return_events)
 
-        # Merge them together
-        events = list(game_events) + list(tracker_events)
-        events = sorted(events, key=lambda x:x['_gameloop'])
+    if archive != None:
+        protocol_registry.add_decode_time(used_build, time.time() - decode_start)
 
     # Create output
     replay = dict()
     replay['file'] = file
     replay['build'] = {'replay_build': replay_build, 'protocol_build': used_build}
-    replay['date'] = time.strftime('%Y:%m:%d:%H:%M:%S', time.localtime(os.path.getmtime(file)))
+    replay['date'] = time.strftime('%Y:%m:%d:%H:%M:%S', time.localtime(key[2]))
 
     if metadata['Title'] in map_names:
         replay['map_name'] = map_names[metadata['Title']]['EN']
@@ -132,13 +356,13 @@ def s2_parse_replay(file, try_lastest=True, parse_events=True, onlyBlizzard=Fals
         replay['map_name'] = metadata['Title']
 
     replay['isBlizzard'] = player_info['m_isBlizzardMap']
-    replay['extension'] = detailed_info['m_syncLobbyState']['m_gameDescription']['m_hasExtensionMod']
+    replay['extension'] = extension
     replay['brutal_plus'] = detailed_info['m_syncLobbyState']['m_lobbyState']['m_slots'][0].get('m_brutalPlusDifficulty',0)
     replay['length'] = metadata['Duration']
-    replay['start_time'] = get_start_time(events)
-    replay['last_deselect_event'] = get_last_deselect_event(events)
+    replay['start_time'] = start_time
+    replay['last_deselect_event'] = last_deselect_event
     replay['last_deselect_event'] = replay['last_deselect_event'] if replay['last_deselect_event'] != None else replay['length']
-    replay['result'] = 'Victory' if metadata['Players'][0]['Result'] == 'Win' or metadata['Players'][1]['Result'] == 'Win' else 'Defeat'
+    replay['result'] = 'Victory' if victory else 'Defeat'
 
     if replay['result'] == 'Victory' and parse_events:
         replay['accurate_length'] = replay['last_deselect_event'] - replay['start_time']
@@ -149,7 +373,7 @@ def s2_parse_replay(file, try_lastest=True, parse_events=True, onlyBlizzard=Fals
 
     if parse_events:
         try:
-            replay['mutators'] = identify_mutators(events, extension=replay['extension'], mm='[MM]' in file)
+            replay['mutators'] = identify_mutators(mutator_events, extension=replay['extension'], mm='[MM]' in file)
         except:
             replay['mutators'] = list()
             logger.error(traceback.format_exc())
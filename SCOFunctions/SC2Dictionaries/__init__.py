@@ -9,6 +9,7 @@ import os as _os
 from ._data_utils import (csv_to_dictitems as _csv_to_dictitems,
                           txt_to_iter as _txt_to_iter,
                           csv_to_comastery_dict as _csv_to_comastery_dict,
+                          reverse_index as _reverse_index,
                           get_file_path
 )
 
@@ -83,6 +84,10 @@ prestige_upgrades = {
              'CommanderPrestigeZeratulTornadoes': 'Herald of the Void',
              }}
 
+# Reverse lookups built once: {upgrade: (commander, mastery index)} and {upgrade: prestige name}
+mastery_upgrade_index = _reverse_index(COMasteryUpgrades)
+prestige_upgrade_names = _reverse_index(prestige_upgrades, value=lambda commander, upgrades, upgrade: upgrades[upgrade])
+
 prestige_names = {
 'Abathur': {0: 'Evolution Master',
              1: 'Essence Hoarder',
@@ -3,6 +3,7 @@
 import os
 import sys
 import csv
+from types import MappingProxyType
 
 
 def csv_to_dictitems(filename, *, header=1):
@@ -43,6 +44,21 @@ def csv_to_comastery_dict(filename, *, header=1):
         return {row[0]: row[1:] for row in reader if row}
 
 
+def reverse_index(nested, value=None):
+    """Build a read-only reverse index of a {outer: inner} dictionary
+
+    Inner items are keys of the reverse index. The first occurrence wins.
+    `value(outer, inner, item)` returns the value stored for each item,
+    defaults to (outer, position of the item in inner).
+    """
+    index = dict()
+    for outer, inner in nested.items():
+        for position, item in enumerate(inner):
+            if not item in index:
+                index[item] = (outer, position) if value is None else value(outer, inner, item)
+    return MappingProxyType(index)
+
+
 def get_file_path(file,subfolder=''):
     """Get path to file
 
@@ -0,0 +1,66 @@
+"""
+Tests for the overlay store. Run from the main folder: python -m unittest discover tests
+
+"""
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.getcwd())
+from SCOFunctions.MOverlayStore import OverlayStore
+
+
+def replay(file):
+    return {'replaydata': True,
+            'filepath': file,
+            'parser': {'difficulty': ('Brutal', 'Brutal'), 'players': [{}, {'custom_kill_count': {1: 5, 2: 3}}]},
+            'mainUnits': {'Marine': [10, 2, 40, 0.5]}}
+
+
+class TestOverlayStore(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.file = os.path.join(self.folder.name, 'store.dat')
+
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+
+    def test_types_are_kept(self):
+        """ Int keys and tuples are the same from memory and from the file """
+        store = OverlayStore(self.file)
+        store.put('a', replay('a'))
+        self.assertEqual(store.get('a'), replay('a'))
+
+        reopened = OverlayStore(self.file)
+        self.assertEqual(reopened.get('a'), replay('a'))
+        self.assertEqual(dict(reopened.items()), {'a': replay('a')})
+
+
+    def test_latest_record_is_used(self):
+        store = OverlayStore(self.file, recent_limit=1)
+        store.put('a', replay('a'))
+        store.put_many({'b': replay('b'), 'a': dict(replay('a'), result='Victory')})
+
+        reopened = OverlayStore(self.file)
+        self.assertEqual(len(reopened), 2)
+        self.assertEqual(reopened.get('a')['result'], 'Victory')
+        reopened.compact()
+        self.assertEqual(OverlayStore(self.file).get('b'), replay('b'))
+
+
+    def test_legacy_file_is_migrated(self):
+        legacy = os.path.join(self.folder.name, 'legacy.txt')
+        with open(legacy, 'wb') as f:
+            f.write((str(replay('a')) + '\n').encode('utf-8'))
+
+        store = OverlayStore(self.file, legacy_file=legacy)
+        self.assertIn('a', store)
+        self.assertEqual(OverlayStore(self.file).get('a'), replay('a'))
+
+
+if __name__ == '__main__':
+    unittest.main()